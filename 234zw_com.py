@@ -4,10 +4,22 @@
 #
 
 import yem
+from bookspider import ChapterStore
 from phyhtml import *
 from phymisc import *
 
 ENCODING = 'GBK'
+TEXT_ONLY = strainer('div', 'box_box')
+# read chapter texts with phyhtml.fetch_lines instead of building a soup
+STREAM_TEXT = True
+
+
+ATTRIBUTES = Template(
+    cover=Field(select('div', 'p_box'), 'img', attr='src', convert=None),
+    title=Field(select('div', 'j_box'), 'h2'),
+    info=Field(select('div', 'j_box'), select('div', 'info'), 'li', many=True, keep_tag=True),
+    intro=Field(select('div', 'j_box'), select('div', 'words'), 'p', convert=None)
+)
 
 
 def fetch_attributes(book, url):
@@ -16,12 +28,10 @@ def fetch_attributes(book, url):
         app_error('cannot open url: {0}', url)
         return
     host = host_of(soup)
-    div = find_tag(soup, 'div', 'p_box')
-    book.cover = yem.Flob.for_url(host + div.img['src'])
-    div = find_tag(soup, 'div', 'j_box')
-    book.title = div.h2.string.strip()
-    info = find_tag(div, 'div', 'info')
-    for li in info.find_all('li'):
+    attrs = ATTRIBUTES.extract(soup)
+    book.cover = yem.Flob.for_url(host + attrs['cover'])
+    book.title = attrs['title']
+    for li in attrs['info']:
         label = li.span.string
         if label == '作者：':
             book.author = li.a.string.strip()
@@ -33,23 +43,55 @@ def fetch_attributes(book, url):
             pass
         elif label == '状态：':
             book.state = li.span.next_sibling
-    intro = find_tag(div, 'div', 'words')
-    lines = [i.strip() for i in intro.p.text.splitlines()]
+    lines = [i.strip() for i in attrs['intro'].splitlines()]
     book.intro = '\n'.join(lines)[3:]
     return soup
 
 
-def fetch_contents(book, soup):
+def fetch_contents(book, soup, concurrency=1, rate=None, store: ChapterStore = None):
     host = host_of(soup)
     div = find_tag(soup, 'div', 'list_box')
-    for a in div.find_all('a'):
-        text = yem.Text.for_html(host + a['href'], fetch_text)
-        book.append(yem.Chapter(text=text, title=a.string.strip()))
+    links = [(host + a['href'], a.string.strip()) for a in div.find_all('a')]
+    if not store:
+        if concurrency > 1:
+            soups = fetch_html_many((url for url, _ in links), concurrency, rate, encoding=ENCODING, only=TEXT_ONLY)
+            for (url, title), page in zip(links, soups):
+                book.append(yem.Chapter(text=yem.Text.for_string(parse_text(page)), title=title))
+        else:
+            for url, title in links:
+                book.append(yem.Chapter(text=yem.Text.for_html(url, fetch_text), title=title))
+        return
+    # chapters kept from an earlier run are read back from the store when the book is written
+    missing = [url for url, title in links if store.track(url, title)]
+    if concurrency > 1:
+        for url, page in zip(missing, fetch_html_many(missing, concurrency, rate, encoding=ENCODING, only=TEXT_ONLY)):
+            text = parse_text(page)
+            if text:
+                store.put(url, text)
+    fetch = store.fetcher(fetch_text)
+    for url, title in links:
+        book.append(yem.Chapter(text=yem.Text.for_html(url, fetch), title=title))
 
 
 def fetch_text(url):
     try:
-        soup = fetch_html(url, encoding=ENCODING)
+        if STREAM_TEXT:
+            lines = fetch_lines(url, 'div', 'box_box', direct=True, encoding=ENCODING)
+            if lines is None:
+                app_error('cannot open url: {0}', url)
+                return ''
+            return join_text(lines)
+        soup = fetch_html(url, encoding=ENCODING, only=TEXT_ONLY)
+        if soup is None:
+            app_error('cannot open url: {0}', url)
+            return ''
+        return parse_text(soup)
+    except:
+        return ''
+
+
+def parse_text(soup):
+    try:
         div = find_tag(soup, 'div', 'box_box')
         lines = []
         for tag in div:
@@ -57,15 +99,23 @@ def fetch_text(url):
                 s = tag.string.strip()
                 if len(s) != 0:
                     lines.append(s)
-        lines.pop()
-        return "\n".join(lines)
+        return join_text(lines)
     except:
         return ""
 
 
+def join_text(lines):
+    # the last line is the site's notice
+    if not lines:
+        return ""
+    lines.pop()
+    return "\n".join(lines)
+
+
 if __name__ == '__main__':
     url = 'http://234zw.com/xingjiqiyuan/'
     book = yem.Book()
     soup = fetch_attributes(book, url)
-    fetch_contents(book, soup)
-    yem.make_book(book, r'E:\tmp')
+    with ChapterStore() as store:
+        fetch_contents(book, soup, concurrency=8, rate=10, store=store)
+        yem.make_book(book, r'E:\tmp')
@@ -1,6 +1,139 @@
 # Book spider interface
 #
 
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+from urllib import parse
+
+import yem
+
+# host: site module implementing fetch_attributes(book, url) and fetch_contents(book, soup, ..., store)
+SITES = {
+    '234zw.com': '234zw_com',
+    'www.zhuishu.com': 'www_zhuishu_com',
+    'www.mangg.com': 'www_zhuishu_com'
+}
+
+
+class ChapterStore:
+    """Chapter texts by URL, zlib-compressed on disk with the `hot_size` most recently used kept in memory.
+
+    Without `path` a temporary directory is used and removed on `close`. Otherwise an index of title and
+    content hash per URL is saved on `close`, so a later run only fetches chapters that `track` reports.
+    """
+
+    def __init__(self, path=None, hot_size=32, level=6):
+        self.temporary = path is None
+        self.path = tempfile.mkdtemp(prefix='chapters-') if path is None else path
+        os.makedirs(self.path, exist_ok=True)
+        self.hot_size = hot_size
+        self.level = level
+        self.changed = 0
+        self._hot = OrderedDict()
+        self._lock = threading.Lock()
+        self._index = {}
+        index = os.path.join(self.path, 'index.json')
+        if not self.temporary and os.path.exists(index):
+            with open(index, encoding='utf-8') as fp:
+                self._index = json.load(fp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _path_of(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.z')
+
+    def _remember(self, url, text):
+        with self._lock:
+            self._hot[url] = text
+            self._hot.move_to_end(url)
+            if len(self._hot) > self.hot_size:
+                self._hot.popitem(last=False)
+
+    def __contains__(self, url):
+        return url in self._hot or os.path.exists(self._path_of(url))
+
+    def track(self, url, title) -> bool:
+        """Registers chapter `title` at `url`, returns whether it has to be fetched: new, retitled or never stored."""
+        with self._lock:
+            entry = self._index.setdefault(url, {'title': title, 'hash': None})
+            if entry['title'] != title:
+                entry['title'] = title
+                self._hot.pop(url, None)
+                entry['hash'] = None
+            elif entry['hash'] is not None and url in self:
+                return False
+        try:
+            os.remove(self._path_of(url))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def put(self, url, text):
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        with self._lock:
+            entry = self._index.setdefault(url, {'title': None, 'hash': None})
+            if entry['hash'] != digest:
+                self.changed += 1
+                entry['hash'] = digest
+        path = self._path_of(url)
+        tmp = '{0}.{1}.tmp'.format(path, threading.get_ident())
+        with open(tmp, 'wb') as fp:
+            fp.write(zlib.compress(text.encode('utf-8'), self.level))
+        os.replace(tmp, path)
+        self._remember(url, text)
+
+    def get(self, url):
+        with self._lock:
+            text = self._hot.get(url)
+        if text is not None:
+            return text
+        try:
+            with open(self._path_of(url), 'rb') as fp:
+                text = zlib.decompress(fp.read()).decode('utf-8')
+        except FileNotFoundError:
+            return None
+        self._remember(url, text)
+        return text
+
+    def fetcher(self, fetch_text):
+        """Wraps a `fetch_text(url, ...)` callback to fetch each chapter once and serve it from the store."""
+
+        def fetch(url, *args):
+            text = self.get(url)
+            if text is None:
+                text = fetch_text(url, *args)
+                if text:
+                    self.put(url, text)
+            return text
+
+        return fetch
+
+    def save(self):
+        if self.temporary:
+            return
+        tmp = os.path.join(self.path, 'index.json.tmp')
+        with self._lock, open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump(self._index, fp, ensure_ascii=False)
+        os.replace(tmp, os.path.join(self.path, 'index.json'))
+
+    def close(self):
+        self._hot.clear()
+        if self.temporary:
+            shutil.rmtree(self.path, ignore_errors=True)
+        else:
+            self.save()
+
 
 def fetch_attributes(url):
     pass
@@ -14,8 +147,31 @@ def fetch_text():
     pass
 
 
-def fetch_book(url):
-    pass
+def site_of(url):
+    host = parse.urlsplit(url).netloc
+    name = SITES.get(host)
+    if name is None:
+        raise ValueError("unsupported site '{0}'".format(url))
+    return importlib.import_module(name)
+
+
+def fetch_book(url, path='.', fmt=None, incremental=True, concurrency=8, rate=None, **args):
+    """Fetches the book at `url` and makes it in `path`.
+
+    In incremental mode chapters are kept in a store under `path`, a rerun only downloads chapters that are
+    new, retitled or failed before, and the book is rebuilt from the stored texts.
+    """
+    site = site_of(url)
+    book = yem.Book()
+    soup = site.fetch_attributes(book, url)
+    if soup is None:
+        return None
+    cache = os.path.join(path, '.chapters', hashlib.sha1(url.encode('utf-8')).hexdigest()) if incremental else None
+    with ChapterStore(cache) as store:
+        site.fetch_contents(book, soup, concurrency, rate, store=store)
+        result = yem.make_book(book, path, fmt, **args) if fmt else yem.make_book(book, path, **args)
+        print('{0} new or changed chapters'.format(store.changed))
+        return result
 
 
 if __name__ == '__main__':
@@ -32,14 +32,17 @@ spider_config = {
 }
 
 
-def fetch_images(url, path, use_title=True):
+def fetch_images(url, path, use_title=True, workers=1):
     cfg = spider_config.get(phyhtml.host_of(url))
     if cfg is None:
         raise ValueError("unsupported site '{0}'".format(url))
-    soup = phyhtml.open_soup(url, encoding=cfg["charset"])
+    soup = phyhtml.fetch_html(url, encoding=cfg["charset"])
+    if soup is None:
+        raise ValueError("cannot open url '{0}'".format(url))
     results = cfg["spider"](soup)
     print("found {0} images with title '{1}'".format(len(results[1]), results[0]))
-    phyhtml.save_files(results[1], os.path.join(path, results[0]) if use_title else path, use_title)
+    phyhtml.save_files(results[1], os.path.join(path, results[0]) if use_title else path, use_title,
+                       workers=workers)
 
 
 def url_for_parts(host, category, item):
@@ -47,12 +50,12 @@ def url_for_parts(host, category, item):
 
 
 def print_usage():
-    phymisc.app_usage("""-H -h <XIAMI_host> -album <item> -c <category> -u <url> -e <ENCODING> save_dir""")
+    phymisc.app_usage("""-H -h <XIAMI_host> -album <item> -c <category> -u <url> -e <ENCODING> -w <workers> save_dir""")
 
 
 def main(argv):
     phymisc.app_name = os.path.basename(argv[0])
-    options = "Hh:c:album:u:e:Z"
+    options = "Hh:c:album:u:e:w:Z"
     try:
         opts, args = getopt.getopt(argv[1:], options)
     except getopt.GetoptError as err:
@@ -64,6 +67,7 @@ def main(argv):
     category = None
     item = None
     for_zip = True
+    workers = 1
     for opt, value in opts:
         if opt == "-h":
             host = value
@@ -75,6 +79,14 @@ def main(argv):
             url = value
         elif opt == "-Z":
             for_zip = False
+        elif opt == "-w":
+            try:
+                workers = int(value)
+            except ValueError:
+                workers = 0
+            if workers < 1:
+                phymisc.app_error("invalid worker count: {0}".format(value))
+                return -1
         elif opt == "-H":
             print_usage()
             return 0
@@ -97,7 +109,7 @@ def main(argv):
         save_dir = args[0]
 
     print("downloading images from {0} to {1}".format(url, save_dir))
-    fetch_images(url, save_dir, for_zip)
+    fetch_images(url, save_dir, for_zip, workers)
     return 0
 
 
@@ -6,7 +6,7 @@
 import datetime
 
 import yem
-from phyhtml1 import *
+from phyhtml import *
 
 encoding = "utf-8"
 base_url = "http://k.sogou.com/"
@@ -23,7 +23,7 @@ def parse_search_results(soup):
     books = []
     if len(sections) == 2:
         books.append(parse_book_item(sections[0]))
-    ul = tag_of_class(sections[-1], "ul", "booklst")
+    ul = find_tag(sections[-1], "ul", "booklst")
     for li in ul.find_all("li"):
         b = parse_book_item(li)
         if b:
@@ -31,39 +31,49 @@ def parse_search_results(soup):
     return books
 
 
+BOOK_ITEM = select("a", "booklst-tab vertical-wrap")
+BOOK_ITEM_FIELDS = Template(
+    href=Field(BOOK_ITEM, attr="href", convert=None),
+    cover=Field(BOOK_ITEM, "img", attr="data-original", convert=None),
+    title=Field(BOOK_ITEM, select("div", "booklst-tit")),
+    spans=Field(BOOK_ITEM, select("div", "booklst-txt"), "span", many=True, convert=None),
+    intro=Field(BOOK_ITEM, select("p", "booklst-gap")),
+    keywords=Field(BOOK_ITEM, select("ul", "booklst-sort"), "li", many=True),
+    update=Field(select("a", "update-wrap"), convert=lambda s: conv_text(s.replace("\n", " ")))
+)
+
+BOOK_DETAIL = select("div", "book-detail-wrap")
+BOOK_DETAIL_FIELDS = Template(
+    title=Field(BOOK_DETAIL, "h2", convert=None),
+    cover=Field(BOOK_DETAIL, "img", attr="data-original", convert=None),
+    info=Field(BOOK_DETAIL, "p", keep_tag=True),
+    keywords=Field(BOOK_DETAIL, select("div", "book-detail-sort"), "a", many=True, convert=None),
+    intro=Field(select("p", "book-read-info"), attr="onclick", convert=None)
+)
+
+
 def parse_book_item(soup):
-    a = tag_of_class(soup, "a", "booklst-tab vertical-wrap")
-    if not a:
+    item = BOOK_ITEM_FIELDS.extract(soup)
+    if item["href"] is None:
         return
-    url = base_url + a["href"]
-    cover = a.find("img")["data-original"].replace("w/76?", "w/360?")
-    title = conv_text(tag_of_class(a, "div", "booklst-tit").text)
-    spans = tag_of_class(a, "div", "booklst-txt").find_all("span")
-    author = spans[0].text
-    genre = spans[1].text
-    state = spans[2].text
-    intro = conv_text(tag_of_class(a, "p", "booklst-gap").text)
-    keywords = []
-    for li in tag_of_class(a, "ul", "booklst-sort").find_all("li"):
-        keywords.append(conv_text(li.text))
-    updates = [conv_text(tag_of_class(soup, "a", "update-wrap").text.replace("\n", " "))]
-    return dict(url=url, title=title, author=author, cover=cover, genre=genre, state=state, keywords=keywords,
-                intro=intro, updates=updates)
+    author, genre, state = item["spans"][:3]
+    return dict(url=base_url + item["href"], title=item["title"], author=author,
+                cover=item["cover"].replace("w/76?", "w/360?"), genre=genre, state=state, keywords=item["keywords"],
+                intro=item["intro"], updates=[item["update"]])
 
 
 def fetch_attributes(book, soup):
-    div = tag_of_class(soup, "div", "book-detail-wrap")
-    book.title = div.find("h2").text
-    book.cover = yem.File.for_url(div.find("img")["data-original"].replace("w/97?", "w/360?"))
-    for x in div.find("p"):
+    detail = BOOK_DETAIL_FIELDS.extract(soup)
+    book.title = detail["title"]
+    book.cover = yem.File.for_url(detail["cover"].replace("w/97?", "w/360?"))
+    for x in detail["info"]:
         if x.name is None:
             book.genre, book.author = x.split("/")
         else:
             book.state, y = x.text.strip().split("\n")[0].split("（")
             book.pubdate = datetime.datetime.strptime(y.rstrip("）"), "%Y-%m-%d")
-    book.keywords = [a.text for a in tag_of_class(div, "div", "book-detail-sort").find_all("a")]
-    p = tag_of_class(soup, "p", "book-read-info")
-    book.intro = yem.Text.for_string(p["onclick"].lstrip("showMoreDesc('").rstrip("')"))
+    book.keywords = detail["keywords"]
+    book.intro = yem.Text.for_string(detail["intro"].lstrip("showMoreDesc('").rstrip("')"))
 
 
 def fetch_contents(book, soup):
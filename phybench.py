@@ -0,0 +1,563 @@
+#  Copyright 2016 Peng Wan <phylame@163.com>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""PW's Benchmarks"""
+
+import contextlib
+import glob
+import hashlib
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import traceback
+import zlib
+from http import server
+from urllib import request
+
+import phyhtml
+
+DEFAULT_PAGE = b"<html><head><title>bench</title></head><body><div id='content'>hello</div></body></html>"
+
+
+class StandInHandler(server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = self.server.pages.get(self.path.split("?")[0], DEFAULT_PAGE)
+        etag = '"{0:x}"'.format(zlib.crc32(body))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(pages: dict = None, handler=StandInHandler) -> server.ThreadingHTTPServer:
+    """Starts a local HTTP stand-in on a free port, `pages` maps path to body bytes."""
+    httpd = server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    httpd.daemon_threads = True
+    httpd.pages = pages or {}
+    httpd.url = "http://127.0.0.1:{0}".format(httpd.server_port)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def timed(func, count):
+    begin = time.perf_counter()
+    for i in range(count):
+        func(i)
+    return time.perf_counter() - begin
+
+
+def report(name, count, seconds, unit="req"):
+    print("{0:<24} {1:>8} {2} in {3:7.3f}s  {4:10.1f} {2}/s".format(name, count, unit, seconds, count / seconds))
+
+
+def bench_session(count=1000):
+    count = int(count)
+    httpd = serve()
+    url = httpd.url + "/chapter/{0}.html"
+
+    def plain(i):
+        with phyhtml.open_url(url.format(i)) as response:
+            response.read()
+
+    report("open_url", count, timed(plain, count))
+    with phyhtml.Session() as session:
+        def pooled(i):
+            with phyhtml.open_url(url.format(i), session=session) as response:
+                response.read()
+
+        report("open_url(session)", count, timed(pooled, count))
+    httpd.shutdown()
+
+
+def sample_chapter(lines=3000):
+    """Generates a chapter page with navigation, text in div.box_box and a footer."""
+    nav = "".join("<li><a href='/c/{0}.html'>chapter {0}</a></li>".format(i) for i in range(lines // 2))
+    text = "<br/>\n".join("&nbsp;&nbsp;line {0} of the chapter text, filler filler filler.".format(i)
+                           for i in range(lines))
+    return ("<html><head><meta charset='utf-8'><title>sample</title></head><body>"
+            "<div class='nav'><ul>{0}</ul></div><div class='box_box'>{1}</div>"
+            "<div class='footer'><ul>{0}</ul></div></body></html>").format(nav, text).encode("utf-8")
+
+
+def bench_parsers(path=None, name="div", clazz="box_box", id=None, rounds=5):
+    """Compares full and strained parsing per installed backend over *.html in `path`."""
+    if path:
+        pages = []
+        for file in glob.glob(os.path.join(path, "*.html")):
+            with open(file, "rb") as fp:
+                pages.append(fp.read())
+    else:
+        pages = [sample_chapter()]
+    only = phyhtml.strainer(name, clazz, id)
+    count = len(pages) * int(rounds)
+    for parser in ("lxml", "html5lib", "html.parser"):
+        if phyhtml.bs4.builder.builder_registry.lookup(parser) is None:
+            print("{0:<24} not installed".format(parser))
+            continue
+        report(parser, count, timed(lambda i: phyhtml.parse_html(pages[i % len(pages)], "utf-8", parser), count),
+               "page")
+        report(parser + " (strained)", count,
+               timed(lambda i: phyhtml.parse_html(pages[i % len(pages)], "utf-8", parser, only), count), "page")
+
+
+def direct_lines(tag):
+    return [s.strip() for s in tag if s.name is None and s.strip()] if tag is not None else []
+
+
+def bench_text(rounds=20, lines=3000):
+    """Times chapter text extraction with bs4, strained bs4 and phyhtml.extract_lines, parsing and fetching."""
+    page = sample_chapter(int(lines))
+    count = int(rounds)
+    only = phyhtml.strainer("div", "box_box")
+    expected = direct_lines(phyhtml.find_tag(phyhtml.parse_html(page, "utf-8"), "div", "box_box"))
+    if phyhtml.extract_lines(page, "div", "box_box", encoding="utf-8", direct=True) != expected:
+        raise AssertionError("extract_lines differs from bs4")
+    report("bs4", count, timed(
+        lambda i: direct_lines(phyhtml.find_tag(phyhtml.parse_html(page, "utf-8"), "div", "box_box")), count), "page")
+    report("bs4 (strained)", count, timed(
+        lambda i: direct_lines(phyhtml.find_tag(phyhtml.parse_html(page, "utf-8", only=only), "div", "box_box")),
+        count), "page")
+    report("extract_lines", count, timed(
+        lambda i: phyhtml.extract_lines(page, "div", "box_box", encoding="utf-8", direct=True), count), "page")
+    httpd = serve({"/chapter.html": page})
+    url = httpd.url + "/chapter.html"
+    with phyhtml.Session() as session:
+        report("fetch_html (strained)", count, timed(lambda i: direct_lines(phyhtml.find_tag(
+            phyhtml.fetch_html(url, session=session, only=only), "div", "box_box")), count), "page")
+        report("fetch_lines", count, timed(
+            lambda i: phyhtml.fetch_lines(url, "div", "box_box", direct=True, session=session), count), "page")
+    httpd.shutdown()
+
+
+class SQLiteCursor:
+    """Makes a sqlite3 connection look like a pymysql cursor, charging `latency` seconds per statement."""
+
+    def __init__(self, path=":memory:", latency=0.0002):
+        import sqlite3
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.latency = latency
+        self.connection = self
+        self.statements = 0
+        self._cursor = self.db.cursor()
+
+    def _call(self, func, sql, args):
+        self.statements += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return func(sql.replace("%s", "?"), args)
+
+    def execute(self, sql, args=()):
+        self._call(self._cursor.execute, sql, args)
+        return self._cursor.rowcount
+
+    def executemany(self, sql, args):
+        self._call(self._cursor.executemany, sql, args)
+        return self._cursor.rowcount
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    def begin(self):
+        if not self.db.in_transaction:
+            self.execute("begin")
+
+    def commit(self):
+        if self.db.in_transaction:
+            self.execute("commit")
+
+    def rollback(self):
+        if self.db.in_transaction:
+            self.execute("rollback")
+
+    def close(self):
+        pass
+
+
+SONG_LINKS = ("song_artist", "song_tag", "song_genre", "song_composer", "song_arranger", "song_lyricist")
+
+
+def bench_psm(songs=500, links=5):
+    """Writes the link rows of `songs` songs row by row, with executemany and through PSMHelper.bulk()."""
+    import psm
+
+    def helper_for():
+        cursor = SQLiteCursor()
+        for table in SONG_LINKS:
+            cursor.execute("create table {0}(song_id int, item_id int)".format(table))
+        return psm.PSMHelper(cursor)
+
+    songs = int(songs)
+    rows = songs * links * len(SONG_LINKS)
+    ids = tuple(range(1, links + 1))
+
+    helper = helper_for()
+
+    def row_by_row(i):
+        helper.begin()
+        for table in SONG_LINKS:
+            for link in ids:
+                helper.execute("insert into {0}(song_id, item_id) values(%s, %s)".format(table), i, link)
+        helper.commit()
+
+    report("row by row", rows, timed(row_by_row, songs), "row")
+    helper = helper_for()
+    report("insert_links", rows, timed(
+        lambda i: [helper.insert_links(table, ("song_id", "item_id"), i, ids, "items", "item") for table in SONG_LINKS],
+        songs), "row")
+    helper = helper_for()
+    begin = time.perf_counter()
+    with helper.bulk() as links_buffer:
+        for i in range(songs):
+            for table in SONG_LINKS:
+                helper.insert_links(table, ("song_id", "item_id"), i, ids, "items", "item")
+            helper.commit()
+    report("bulk", links_buffer.rows, time.perf_counter() - begin, "row")
+
+
+PTP_CHILD = """
+import resource, sys, time
+import ptp
+begin = time.perf_counter()
+getattr(ptp, sys.argv[1])(sys.argv[2], ptp.remove_null, "utf-8")
+print(time.perf_counter() - begin, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def generate_text(path, size):
+    line = "　　第一章 他说：“这是一段用来测试的文字，没有句号的行会被合并”\n\n".encode("utf-8")
+    block = line * (1024 * 1024 // len(line))
+    with open(path, "wb") as fp:
+        for _ in range(size // len(block) + 1):
+            fp.write(block)
+
+
+def bench_ptp(size=1024 * 1024 * 1024):
+    """Runs ptp remove_null over a generated `size` bytes text, in memory and streaming, in child processes."""
+    size = int(size)
+    with tempfile.TemporaryDirectory() as path:
+        file = os.path.join(path, "novel.txt")
+        for mode in ("stream_lines", "split_to_lines"):
+            generate_text(file, size)
+            out = subprocess.run([sys.executable, "-c", PTP_CHILD, mode, file], check=True, stdout=subprocess.PIPE,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)), universal_newlines=True).stdout.split()
+            seconds, rss = float(out[0]), int(out[1])
+            report(mode, size // (1024 * 1024), seconds, "MB")
+            print("{0:<24} peak rss {1:.1f} MB".format(mode, rss / 1024))
+
+
+def smart_split_reference(lines):
+    """ptp.smart_split before the list-join rewrite, kept for equivalence checks"""
+    import ptp
+    result = []
+    buf = ""
+    for line in lines:
+        s = line.rstrip()
+        if s.endswith(ptp.CHAPTER_END_SYMBOLS):
+            if buf:
+                s = buf + s.lstrip()
+                buf = ""
+            result.append(s)
+        else:
+            if buf:
+                s = s.lstrip()
+            buf += s
+    return result
+
+
+def random_lines(rng, count):
+    pieces = ("中文", "text", " ", "\u3000", "\t", "。", "！", "”", "...", ",", "a.", "")
+    return ["".join(rng.choice(pieces) for _ in range(rng.randint(0, 6))) for _ in range(count)]
+
+
+def bench_smart_split(lines=200000, cases=2000):
+    """Checks ptp.smart_split against the reference on random inputs, then times both on a broken corpus."""
+    import random
+    import ptp
+    rng = random.Random(0)
+    for _ in range(int(cases)):
+        sample = random_lines(rng, rng.randint(0, 50))
+        if list(ptp.smart_split(sample)) != smart_split_reference(sample):
+            raise AssertionError("smart_split differs from reference on {0!r}".format(sample))
+    print("smart_split matches reference on {0} random inputs".format(cases))
+    lines = int(lines)
+    # paragraphs broken into 1 to 2000 lines
+    corpus = []
+    while len(corpus) < lines:
+        corpus.extend(["　　这是一行被错误断开的段落文字"] * rng.randint(1, 2000))
+        corpus.append("结束。")
+    report("smart_split (reference)", len(corpus), timed(lambda i: smart_split_reference(corpus), 1), "line")
+    report("smart_split", len(corpus), timed(lambda i: list(ptp.smart_split(corpus)), 1), "line")
+
+
+class Fixtures:
+    """Recorded pages under `path`, index.json maps each URL to its file and content type and each site parser
+    to the URLs it was recorded with. In `recording` mode unknown URLs are fetched from the live site."""
+
+    def __init__(self, path, recording=False):
+        self.path = path
+        self.recording = recording
+        self.pages = {}
+        self.targets = {}
+        self._bodies = {}
+        self._lock = threading.Lock()
+        index = os.path.join(path, "index.json")
+        if os.path.exists(index):
+            with open(index, encoding="utf-8") as fp:
+                data = json.load(fp)
+            self.pages, self.targets = data["pages"], data["targets"]
+
+    def get(self, url):
+        with self._lock:
+            page = self._bodies.get(url)
+            entry = self.pages.get(url)
+        if page is None and entry is not None:
+            with open(os.path.join(self.path, entry["file"]), "rb") as fp:
+                page = fp.read(), entry["type"]
+            with self._lock:
+                self._bodies[url] = page
+        if page is None and self.recording:
+            page = self.record(url)
+        return page
+
+    def record(self, url):
+        # the stand-in is installed as proxy for urlopen, so go around it
+        opener = request.build_opener(request.ProxyHandler({}))
+        with opener.open(phyhtml.make_request(url)) as response:
+            page = response.read(), response.headers.get("Content-Type", "text/html")
+        name = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16] + ".html"
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, name), "wb") as fp:
+            fp.write(page[0])
+        with self._lock:
+            self.pages[url] = {"file": name, "type": page[1]}
+            self._bodies[url] = page
+        return page
+
+    def save(self):
+        with open(os.path.join(self.path, "index.json"), "w", encoding="utf-8") as fp:
+            json.dump({"pages": self.pages, "targets": self.targets}, fp, indent=2, sort_keys=True)
+
+
+class FixtureHandler(StandInHandler):
+    """Serves `server.fixtures` by absolute URL, for use as HTTP proxy of the live sites."""
+
+    def do_GET(self):
+        try:
+            page = self.server.fixtures.get(self.path)
+        except Exception as e:
+            self.send_error(502, str(e))
+            return
+        if page is None:
+            self.send_error(404, "no fixture for " + self.path)
+            return
+        body, content_type = page
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@contextlib.contextmanager
+def proxy_to(url):
+    """Routes urlopen, so every fetch helper without a session, through the stand-in at `url`."""
+    request.install_opener(request.build_opener(request.ProxyHandler({"http": url})))
+    try:
+        yield
+    finally:
+        request.install_opener(None)
+
+
+class PhaseTimer:
+    """Wraps fetch_html and parse_html of phyhtml and `module` to split the time of a parser call.
+
+    fetch is fetch_html without parse_html, the rest of the call outside fetch_html counts as extract.
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.fetch = self.parse = 0.0
+        self._saved = []
+
+    def _wrap(self, owner, name, field):
+        func = getattr(owner, name)
+
+        def timed_call(*args, **kwargs):
+            begin = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                setattr(self, field, getattr(self, field) + time.perf_counter() - begin)
+
+        self._saved.append((owner, name, func))
+        setattr(owner, name, timed_call)
+
+    def __enter__(self):
+        self._wrap(phyhtml, "parse_html", "parse")
+        self._wrap(phyhtml, "fetch_html", "fetch")
+        if self.module is not phyhtml and getattr(self.module, "fetch_html", None) is self._saved[-1][2]:
+            # bound by `from phyhtml import *`
+            self._wrap(self.module, "fetch_html", "fetch")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for owner, name, func in reversed(self._saved):
+            setattr(owner, name, func)
+        self._saved.clear()
+        self.fetch -= self.parse
+
+
+# site parser: (module, call with the module and a recorded URL)
+SITE_PARSERS = {
+    "xiami.genre": ("xiami", lambda m, url: m.parse_genre(url)),
+    "xiami.artist": ("xiami", lambda m, url: m.parse_artist(url)),
+    "xiami.album": ("xiami", lambda m, url: m.parse_album(url)),
+    "xiami.song": ("xiami", lambda m, url: m.parse_song(url)),
+    "234zw.attributes": ("234zw_com", lambda m, url: m.fetch_attributes(m.yem.Book(), url)),
+    "zhuishu.attributes": ("www_zhuishu_com", lambda m, url: m.fetch_attributes(m.yem.Book(), url)),
+    "sogou.search": ("k_sogou_com",
+                     lambda m, url: m.parse_search_results(phyhtml.fetch_html(url, encoding=m.encoding)))
+}
+
+
+def record_sites(path, name, *urls):
+    """Runs site parser `name` once per live URL, recording every page it fetches as fixture in `path`."""
+    module_name, run = SITE_PARSERS[name]
+    module = importlib.import_module(module_name)
+    fixtures = Fixtures(path, recording=True)
+    httpd = serve(handler=FixtureHandler)
+    httpd.fixtures = fixtures
+    recorded = fixtures.targets.setdefault(name, [])
+    with proxy_to(httpd.url):
+        for url in urls:
+            try:
+                run(module, url)
+            except Exception:
+                traceback.print_exc()
+                continue
+            if url not in recorded:
+                recorded.append(url)
+    httpd.shutdown()
+    fixtures.save()
+    print("{0:<24} {1} urls, {2} pages recorded".format(name, len(recorded), len(fixtures.pages)))
+
+
+def bench_sites(path="fixtures", rounds=5, output="bench_sites.json"):
+    """Replays the fixtures in `path` through each site parser, compares with and then writes `output`."""
+    fixtures = Fixtures(path)
+    if not fixtures.targets:
+        print("no fixtures in {0}, record them with: phybench.py record_sites {0} <parser> <url>...".format(path))
+        return
+    httpd = serve(handler=FixtureHandler)
+    httpd.fixtures = fixtures
+    results = {}
+    with proxy_to(httpd.url):
+        for name, urls in sorted(fixtures.targets.items()):
+            module_name, run = SITE_PARSERS[name]
+            try:
+                module = importlib.import_module(module_name)
+            except ImportError as e:
+                print("{0:<24} cannot import {1}: {2}".format(name, module_name, e))
+                results[name] = {"error": "cannot import {0}: {1}".format(module_name, e)}
+                continue
+            count = len(urls) * int(rounds)
+            try:
+                run(module, urls[0])  # warm up imports and fixture reads
+                with PhaseTimer(module) as phases:
+                    seconds = timed(lambda i: run(module, urls[i % len(urls)]), count)
+                tracemalloc.start()
+                for url in urls:
+                    run(module, url)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            except Exception as e:
+                traceback.print_exc()
+                results[name] = {"error": "{0}: {1}".format(type(e).__name__, e)}
+                continue
+            extract = seconds - phases.fetch - phases.parse
+            results[name] = {"pages": count, "seconds": seconds, "pages_per_sec": count / seconds,
+                             "fetch": phases.fetch / count, "parse": phases.parse / count, "extract": extract / count,
+                             "peak_kb": peak / 1024}
+            report(name, count, seconds, "page")
+            print("{0:<24} fetch {1:.2f} ms, parse {2:.2f} ms, extract {3:.2f} ms, peak {4:.0f} KB".format(
+                "", *(results[name][k] * 1000 for k in ("fetch", "parse", "extract")), results[name]["peak_kb"]))
+    httpd.shutdown()
+    if output and os.path.exists(output):
+        with open(output, encoding="utf-8") as fp:
+            previous = json.load(fp).get("results", {})
+        for name in sorted(results.keys() | previous.keys()):
+            now, last = results.get(name, {}), previous.get(name, {})
+            if "pages_per_sec" in now and "pages_per_sec" in last:
+                print("{0:<24} {1:+7.1%} pages/s against the last run".format(
+                    name, now["pages_per_sec"] / last["pages_per_sec"] - 1))
+            elif "pages_per_sec" in last:
+                print("{0:<24} failed, ran at {1:.1f} pages/s in the last run: {2}".format(
+                    name, last["pages_per_sec"], now.get("error", "no fixtures")))
+            elif "pages_per_sec" in now:
+                print("{0:<24} runs again, failed in the last run".format(name))
+    if output:
+        with open(output, "w", encoding="utf-8") as fp:
+            json.dump({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+                       "results": results}, fp, indent=2, sort_keys=True)
+
+
+BENCHMARKS = {
+    "session": bench_session,
+    "parsers": bench_parsers,
+    "text": bench_text,
+    "psm": bench_psm,
+    "ptp": bench_ptp,
+    "smart_split": bench_smart_split,
+    "sites": bench_sites,
+    "record_sites": record_sites
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        BENCHMARKS[sys.argv[1]](*sys.argv[2:])
+    else:
+        for name, bench in BENCHMARKS.items():
+            if name != "record_sites":
+                bench()
@@ -14,11 +14,28 @@
 #
 """PW's HTML Utilities"""
 
+import asyncio
+import collections
+import datetime
+import email.utils
+import functools
+import codecs
+import hashlib
+import html.parser
+import http.client
+import io
+import itertools
+import json
+import mmap
 import os
 import random
 import re
+import tempfile
+import threading
+import time
 import zipfile
-from urllib import parse, request
+from concurrent import futures
+from urllib import error, parse, request
 
 import bs4
 import phymisc
@@ -73,16 +90,20 @@ def default_headers():
     }
 
 
-def make_request(url: (str, request.Request), data=None, headers: dict = {}, method: str = None) -> request.Request:
-    _headers = default_headers()
+def make_request(url: (str, request.Request), data=None, headers: dict = {}, method: str = None,
+                 defaults: dict = None) -> request.Request:
+    _headers = dict(defaults) if defaults is not None else default_headers()
     _headers.update(headers)
     if isinstance(url, str):
         url = request.Request(make_url(url), data=make_data(
             data), headers=_headers, method=method)
     elif isinstance(url, request.Request):
-        _headers.update(url.headers)
-        url.headers = _headers
-        url.data = make_data(data)
+        # Request keeps header names capitalize()d, its own headers win over `headers` and the defaults
+        for key, value in _headers.items():
+            if not url.has_header(key.capitalize()):
+                url.add_header(key, value)
+        if data is not None:
+            url.data = make_data(data)
         if method:
             url.method = method
     else:
@@ -90,68 +111,1231 @@ def make_request(url: (str, request.Request), data=None, headers: dict = {}, met
     return url
 
 
-def open_url(url: (str, request.Request), data=None, headers: dict = {}, method: str = None):
-    return request.urlopen(make_request(url, data, headers, method))
+# instrumentation hooks, each called as hook(event, url, seconds=..., size=..., **fields) for
+# connect, throttle, response, download, decode and parse; nothing is timed while empty
+_hooks = []
 
 
-def parse_html(markup, encoding: str = None, parser: str = 'html.parser') -> bs4.BeautifulSoup:
-    return bs4.BeautifulSoup(markup, parser, from_encoding=encoding)
+def add_hook(hook):
+    _hooks.append(hook)
 
 
-def fetch_html(url: (str, request.Request), data=None, headers: dict = {}, method: str = None, encoding: str = None, parser: str = 'html.parser'):
-    response = open_url(url, data, headers, method)
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def _emit(event, url, **fields):
+    for hook in _hooks:
+        hook(event, url, **fields)
+
+
+class Metrics:
+    """Hook aggregating count, seconds and bytes of each event per host, installed while used as context manager.
+
+    response is the time until headers (including connect of new connections), download the time reading the
+    body in `fetch_html`, decode the charset detection and parse the time spent in BeautifulSoup.
+    """
+
+    def __init__(self):
+        self.hosts = collections.defaultdict(lambda: collections.defaultdict(lambda: [0, 0.0, 0]))
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        add_hook(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        remove_hook(self)
+
+    def __call__(self, event, url, seconds=0.0, size=0, **fields):
+        host = parse.urlsplit(url).netloc if url else "-"
+        with self._lock:
+            entry = self.hosts[host][event]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += size
+
+    def summary(self) -> str:
+        lines = []
+        with self._lock:
+            for host in sorted(self.hosts):
+                lines.append(host)
+                for event, (count, seconds, size) in sorted(self.hosts[host].items()):
+                    lines.append("  {0:<10} {1:>7} x {2:9.2f} ms  {3:10.3f} s total  {4:>12} bytes".format(
+                        event, count, seconds * 1000 / count, seconds, size))
+        return "\n".join(lines)
+
+
+class _ConnectionPool:
+    """Idle keep-alive connections to one scheme://netloc."""
+
+    def __init__(self, scheme, netloc, max_connections, idle_timeout, timeout, checkout_timeout=None):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.checkout_timeout = checkout_timeout
+        self._idle = []
+        self._count = 0
+        self._cond = threading.Condition()
+
+    def _prune(self):
+        deadline = time.monotonic() - self.idle_timeout
+        while self._idle and self._idle[0][1] < deadline:
+            self._idle.pop(0)[0].close()
+            self._count -= 1
+
+    def acquire(self) -> http.client.HTTPConnection:
+        # a response nobody closes keeps its connection, waiting forever would stall every request to the host
+        deadline = None if self.checkout_timeout is None else time.monotonic() + self.checkout_timeout
+        with self._cond:
+            while True:
+                self._prune()
+                if self._idle:
+                    return self._idle.pop()[0]
+                if self._count < self.max_connections:
+                    self._count += 1
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise error.URLError("no free connection to {0} after {1} s".format(
+                        self.netloc, self.checkout_timeout))
+                self._cond.wait(remaining)
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def release(self, conn, reuse=True):
+        with self._cond:
+            if reuse and conn.sock is not None:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                conn.close()
+                self._count -= 1
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            for conn, _ in self._idle:
+                conn.close()
+            self._count -= len(self._idle)
+            self._idle.clear()
+
+
+class _PooledResponse:
+    """Wraps `http.client.HTTPResponse`, giving the connection back to its pool once the body is consumed."""
+
+    def __init__(self, response, url, pool, conn):
+        self._response = response
+        self._pool = pool
+        self._conn = conn
+        self.url = url
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _release(self, reuse):
+        if self._conn is not None:
+            self._pool.release(self._conn, reuse)
+            self._conn = None
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self._release(not self._response.will_close)
+        return data
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self._response.status
+
+    def close(self):
+        # unread body left in the socket makes the connection unusable, 204/304 have none
+        reuse = (self._response.isclosed() or self._response.length == 0) and not self._response.will_close
+        self._response.close()
+        self._release(reuse)
+
+
+class Session:
+    """Keeps persistent connections per host and the default headers across requests.
+
+    Requests wait up to `checkout_timeout` seconds for a free connection when `max_connections` are in use.
+    """
+
+    redirect_codes = (301, 302, 303, 307, 308)
+
+    def __init__(self, max_connections: int = 4, idle_timeout: float = 30, timeout: float = None,
+                 headers: dict = None, max_redirects: int = 10, cache=None, scheduler=None,
+                 checkout_timeout: float = 60):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.checkout_timeout = checkout_timeout
+        self.max_redirects = max_redirects
+        self.cache = cache
+        self.scheduler = scheduler
+        self.headers = default_headers()
+        if headers:
+            self.headers.update(headers)
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def pool_of(self, scheme, netloc) -> _ConnectionPool:
+        key = (scheme, netloc)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = _ConnectionPool(scheme, netloc, self.max_connections, self.idle_timeout, self.timeout,
+                                       self.checkout_timeout)
+                self._pools[key] = pool
+            return pool
+
+    def _send(self, req: request.Request):
+        o = parse.urlsplit(req.full_url)
+        if o.scheme not in ("http", "https"):
+            raise ValueError("unsupported scheme '{0}'".format(o.scheme))
+        path = o.path or "/"
+        if o.query:
+            path += "?" + o.query
+        pool = self.pool_of(o.scheme, o.netloc)
+        while True:
+            conn = pool.acquire()
+            reused = conn.sock is not None
+            try:
+                if _hooks and not reused:
+                    begin = time.perf_counter()
+                    conn.connect()
+                    _emit("connect", req.full_url, seconds=time.perf_counter() - begin)
+                conn.request(req.get_method(), path, req.data, dict(req.header_items()))
+                return pool, conn, conn.getresponse()
+            except (ConnectionError, http.client.RemoteDisconnected):
+                pool.release(conn, False)
+                if not reused:
+                    raise
+                # server dropped an idle connection, retry on a fresh one
+            except:
+                pool.release(conn, False)
+                raise
+
+    def open(self, url: (str, request.Request), data=None, headers: dict = {}, method: str = None):
+        req = make_request(url, data, headers, method, self.headers)
+        for _ in range(self.max_redirects + 1):
+            pool, conn, response = self._send(req)
+            location = response.getheader("Location")
+            if response.status not in self.redirect_codes or not location:
+                response = _PooledResponse(response, req.full_url, pool, conn)
+                if response.status >= 400:
+                    raise error.HTTPError(req.full_url, response.status, response.reason, response.headers, response)
+                return response
+            response.read()
+            pool.release(conn, not response.will_close)
+            if response.status == 303 or (response.status in (301, 302) and req.get_method() == "POST"):
+                req = request.Request(parse.urljoin(req.full_url, location), headers=dict(req.header_items()))
+            else:
+                req = request.Request(parse.urljoin(req.full_url, location), data=req.data,
+                                      headers=dict(req.header_items()), method=req.get_method())
+        raise error.HTTPError(req.full_url, response.status, "too many redirects", response.headers, None)
+
+    def close(self):
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.close()
+
+
+class _HostState:
+    def __init__(self, rate, burst, max_in_flight):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Takes a token, returns seconds to wait before the request may start."""
+        with self.lock:
+            now = time.monotonic()
+            wait = 0
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # a negative balance queues the request behind earlier reservations
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = -self.tokens / self.rate
+            return max(wait, self.blocked_until - now)
+
+    def block(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class Scheduler:
+    """Per-host politeness for every fetch helper.
+
+    Each host gets a token bucket of `rate` requests/sec with `burst` capacity and at most `max_in_flight`
+    requests waiting for response headers. On 429/503 the whole host backs off for `Retry-After` or the
+    backoff delay, other transient errors retry with jittered exponential backoff, up to `retries` times.
+    `hosts` maps a netloc to a dict overriding `rate`, `burst` and `max_in_flight`.
+    """
+
+    throttle_codes = (429, 503)
+    transient_codes = (500, 502, 504)
+
+    def __init__(self, rate: float = None, burst: int = 1, max_in_flight: int = 4, retries: int = 3,
+                 backoff: float = 1.0, max_backoff: float = 60.0, hosts: dict = None):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hosts = hosts or {}
+        self.retried = 0
+        self.waited = 0.0
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def state_of(self, host) -> _HostState:
+        with self._lock:
+            state = self._states.get(host)
+            if state is None:
+                options = self.hosts.get(host, {})
+                state = _HostState(options.get("rate", self.rate), options.get("burst", self.burst),
+                                   options.get("max_in_flight", self.max_in_flight))
+                self._states[host] = state
+            return state
+
+    def _delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    @staticmethod
+    def retry_after(e: error.HTTPError):
+        value = e.headers.get("Retry-After") if e.headers else None
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def call(self, url: str, func, *args):
+        state = self.state_of(parse.urlsplit(url).netloc)
+        for attempt in itertools.count():
+            if state.slots:
+                state.slots.acquire()
+            try:
+                wait = state.reserve()
+                if wait > 0:
+                    self.waited += wait
+                    if _hooks:
+                        _emit("throttle", url, seconds=wait)
+                    time.sleep(wait)
+                return func(*args)
+            except error.HTTPError as e:
+                if attempt >= self.retries or e.code not in self.throttle_codes + self.transient_codes:
+                    raise
+                e.close()
+                if e.code in self.throttle_codes:
+                    delay = self.retry_after(e)
+                    state.block(self._delay(attempt) if delay is None else delay)
+                    delay = 0
+                else:
+                    delay = self._delay(attempt)
+            except (error.URLError, http.client.HTTPException, ConnectionError, TimeoutError):
+                if attempt >= self.retries:
+                    raise
+                delay = self._delay(attempt)
+            finally:
+                if state.slots:
+                    state.slots.release()
+            self.retried += 1
+            if delay:
+                self.waited += delay
+                if _hooks:
+                    _emit("throttle", url, seconds=delay)
+                time.sleep(delay)
+
+
+# used by open_url when neither the call nor its session gives a scheduler
+default_scheduler = None
+
+
+def _send(req: request.Request, session, scheduler):
+    send = session.open if session is not None else request.urlopen
+    if scheduler is None:
+        return send(req)
+    return scheduler.call(req.full_url, send, req)
+
+
+class _CachedResponse:
+    """Response replayed from a `ResponseCache` entry or an `Archive` record."""
+
+    from_cache = True
+
+    def __init__(self, url, status, headers, fp):
+        self.url = url
+        self.status = status
+        self.headers = self.msg = headers
+        self._fp = fp
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def read(self, amt=None):
+        return self._fp.read(amt)
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def close(self):
+        self._fp.close()
+
+
+class ResponseCache:
+    """On-disk cache of response bodies and headers, keyed by method, URL and body.
+
+    Entries carrying `ETag` or `Last-Modified` are revalidated with a conditional request, entries
+    without validators are served as stored. Entries younger than `max_age` seconds are always served
+    without touching the network. Least recently used entries are evicted past `max_size` bytes.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, path: str, max_size: int = 512 * 1024 * 1024, max_age: float = None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = self.misses = self.revalidated = self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        metas = [name for name in os.listdir(path) if name.endswith(".json")]
+        metas.sort(key=lambda name: os.path.getmtime(os.path.join(path, name)))
+        for name in metas:
+            key = name[:-5]
+            body = self._path_of(key, ".body")
+            if os.path.exists(body):
+                self._entries[key] = os.path.getsize(body)
+                self._size += self._entries[key]
+
+    @staticmethod
+    def key_of(req: request.Request) -> str:
+        h = hashlib.sha1("{0} {1}\n".format(req.get_method(), req.full_url).encode("utf-8"))
+        if req.data:
+            h.update(req.data)
+        return h.hexdigest()
+
+    def _path_of(self, key, suffix):
+        return os.path.join(self.path, key + suffix)
+
+    def _load(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+        try:
+            with open(self._path_of(key, ".json"), encoding="utf-8") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def _touch(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        try:
+            os.utime(self._path_of(key, ".json"))
+        except OSError:
+            pass
+
+    def _replay(self, key, meta):
+        headers = http.client.parse_headers(io.BytesIO(meta["headers"].encode("iso-8859-1")))
+        return _CachedResponse(meta["url"], meta["status"], headers, open(self._path_of(key, ".body"), "rb"))
+
+    def _store(self, key, response):
+        tmp = self._path_of(key, ".{0}.tmp".format(threading.get_ident()))
+        size = 0
+        with response, open(tmp, "wb") as fp:
+            while True:
+                chunk = response.read(self.chunk_size)
+                if not chunk:
+                    break
+                fp.write(chunk)
+                size += len(chunk)
+        meta = {
+            "url": response.geturl(),
+            "status": response.getcode(),
+            "headers": str(response.headers),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "time": time.time()
+        }
+        with self._lock:
+            os.replace(tmp, self._path_of(key, ".body"))
+            with open(self._path_of(key, ".json"), "w", encoding="utf-8") as fp:
+                json.dump(meta, fp)
+            self._size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict()
+        return meta
+
+    def _evict(self):
+        while self._size > self.max_size and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            for suffix in (".json", ".body"):
+                try:
+                    os.remove(self._path_of(key, suffix))
+                except OSError:
+                    pass
+
+    def open(self, url: (str, request.Request), data=None, headers: dict = {}, method: str = None,
+             session: Session = None, scheduler: Scheduler = None):
+        req = make_request(url, data, headers, method, session.headers if session is not None else None)
+        key = self.key_of(req)
+        meta = self._load(key)
+        if meta is not None:
+            validated = meta["etag"] or meta["last_modified"]
+            if (self.max_age is None and not validated) or \
+                    (self.max_age is not None and time.time() - meta["time"] < self.max_age):
+                self.hits += 1
+                self.bytes_saved += self._entries.get(key, 0)
+                self._touch(key)
+                return self._replay(key, meta)
+            if meta["etag"]:
+                req.add_header("If-None-Match", meta["etag"])
+            if meta["last_modified"]:
+                req.add_header("If-Modified-Since", meta["last_modified"])
+        try:
+            response = _send(req, session, scheduler)
+        except error.HTTPError as e:
+            if e.code != 304 or meta is None:
+                raise
+            e.close()
+            response = None
+        if response is not None and response.getcode() == 304:
+            response.close()
+            response = None
+        if response is None:
+            self.revalidated += 1
+            self.bytes_saved += self._entries.get(key, 0)
+            self._touch(key)
+            return self._replay(key, meta)
+        self.misses += 1
+        if response.getcode() != 200:
+            return response
+        return self._replay(key, self._store(key, response))
+
+    def summary(self) -> str:
+        return "cache: {0} hits, {1} revalidated, {2} misses, {3} bytes saved, {4} entries ({5} bytes)".format(
+            self.hits, self.revalidated, self.misses, self.bytes_saved, len(self._entries), self._size)
+
+
+class Archive:
+    """Transport recording responses to, or replaying them from, the single file `path`.
+
+    Records are the JSON meta (URL, status, headers) followed by the body, `path`.idx has one line per record:
+    key, offset, meta size and body size, the last record of a key wins. In "record" mode requests go to the
+    network (through the cache if given) and are appended, in "replay" mode they are served from the
+    memory-mapped file and requests missing from the archive fail with URLError.
+    """
+
+    modes = ("record", "replay")
+
+    def __init__(self, path: str, mode: str = "replay"):
+        if mode not in self.modes:
+            raise ValueError("'mode' require one of {0}".format(", ".join(self.modes)))
+        self.path = path
+        self.mode = mode
+        self.hits = self.misses = self.records = 0
+        self._index = {}
+        self._lock = threading.Lock()
+        self._map = self._data = None
+        if os.path.exists(path + ".idx"):
+            with open(path + ".idx", encoding="utf-8") as fp:
+                for line in fp:
+                    key, *sizes = line.split()
+                    self._index[key] = tuple(map(int, sizes))
+        if mode == "record":
+            self._data = open(path, "ab")
+            self._idx = open(path + ".idx", "a", encoding="utf-8")
+        elif os.path.getsize(path):
+            with open(path, "rb") as fp:
+                self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._index)
+
+    def _append(self, key, url, status, reason, headers, body):
+        meta = json.dumps({"url": url, "status": status, "reason": reason, "headers": str(headers)}).encode("utf-8")
+        with self._lock:
+            offset = self._data.tell()
+            self._data.write(meta)
+            self._data.write(body)
+            self._data.flush()
+            self._idx.write("{0} {1} {2} {3}\n".format(key, offset, len(meta), len(body)))
+            self._idx.flush()
+            self._index[key] = (offset, len(meta), len(body))
+            self.records += 1
+
+    def _record(self, req, session, scheduler, cache):
+        key = ResponseCache.key_of(req)
+        try:
+            response = cache.open(req, session=session, scheduler=scheduler) if cache is not None else \
+                _send(req, session, scheduler)
+        except error.HTTPError as e:
+            body = e.read()
+            e.close()
+            self._append(key, e.geturl(), e.code, e.msg, e.headers, body)
+            raise error.HTTPError(e.geturl(), e.code, e.msg, e.headers, io.BytesIO(body))
+        with response:
+            body = response.read()
+        self._append(key, response.geturl(), response.getcode(), getattr(response, "reason", ""), response.headers,
+                     body)
+        return _CachedResponse(response.geturl(), response.getcode(), response.headers, io.BytesIO(body))
+
+    def _replay(self, req):
+        entry = self._index.get(ResponseCache.key_of(req))
+        if entry is None:
+            self.misses += 1
+            raise error.URLError("not in archive {0}: {1}".format(self.path, req.full_url))
+        self.hits += 1
+        offset, meta_size, body_size = entry
+        meta = json.loads(self._map[offset:offset + meta_size].decode("utf-8"))
+        headers = http.client.parse_headers(io.BytesIO(meta["headers"].encode("iso-8859-1")))
+        offset += meta_size
+        response = _CachedResponse(meta["url"], meta["status"], headers,
+                                   io.BytesIO(self._map[offset:offset + body_size]))
+        if meta["status"] >= 400:
+            raise error.HTTPError(meta["url"], meta["status"], meta["reason"], headers, response)
+        return response
+
+    def open(self, req: request.Request, session: Session = None, scheduler: Scheduler = None,
+             cache: ResponseCache = None):
+        if self.mode == "record":
+            return self._record(req, session, scheduler, cache)
+        return self._replay(req)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._data is not None:
+            self._data.close()
+            self._idx.close()
+            self._data = None
+
+    def summary(self) -> str:
+        return "archive: {0} records, {1} recorded, {2} replayed, {3} missing".format(
+            len(self._index), self.records, self.hits, self.misses)
+
+
+# used by open_url when the call gives no transport, any object with open(req, session, scheduler, cache)
+# taking over the request, e.g. an Archive to record or replay a whole crawl
+default_transport = None
+
+
+def _open(req, session, cache, scheduler, transport):
+    if transport is not None:
+        return transport.open(req, session, scheduler, cache)
+    if cache is not None:
+        return cache.open(req, session=session, scheduler=scheduler)
+    return _send(req, session, scheduler)
+
+
+def open_url(url: (str, request.Request), data=None, headers: dict = {}, method: str = None,
+             session: Session = None, cache: ResponseCache = None, scheduler: Scheduler = None,
+             transport: Archive = None):
+    if session is not None:
+        if cache is None:
+            cache = session.cache
+        if scheduler is None:
+            scheduler = session.scheduler
+    if scheduler is None:
+        scheduler = default_scheduler
+    if transport is None:
+        transport = default_transport
+    req = make_request(url, data, headers, method, session.headers if session is not None else None)
+    if not _hooks:
+        return _open(req, session, cache, scheduler, transport)
+    begin = time.perf_counter()
+    try:
+        response = _open(req, session, cache, scheduler, transport)
+    except error.HTTPError as e:
+        _emit("response", req.full_url, seconds=time.perf_counter() - begin, status=e.code)
+        raise
+    _emit("response", req.full_url, seconds=time.perf_counter() - begin, status=response.getcode())
+    return response
+
+
+# fastest first, html5lib is slower than html.parser and ignores parse_only
+preferred_parsers = ("lxml", "html.parser")
+_best_parser = None
+
+
+def best_parser() -> str:
+    global _best_parser
+    if _best_parser is None:
+        for name in preferred_parsers:
+            if bs4.builder.builder_registry.lookup(name) is not None:
+                _best_parser = name
+                break
+    return _best_parser
+
+
+def strainer(name, clazz=None, id=None) -> bs4.SoupStrainer:
+    attrs = {}
+    if clazz:
+        attrs['class'] = clazz
+    if id:
+        attrs['id'] = id
+    return bs4.SoupStrainer(name, attrs)
+
+
+def parse_html(markup, encoding: str = None, parser: str = None, only: bs4.SoupStrainer = None,
+               url: str = None) -> bs4.BeautifulSoup:
+    if not _hooks:
+        return bs4.BeautifulSoup(markup, parser or best_parser(), from_encoding=encoding, parse_only=only)
+    begin = time.perf_counter()
+    soup = bs4.BeautifulSoup(markup, parser or best_parser(), from_encoding=encoding, parse_only=only)
+    _emit("parse", url, seconds=time.perf_counter() - begin, size=len(markup) if isinstance(markup, bytes) else 0,
+          parser=parser or best_parser())
+    return soup
+
+
+# encodings detected from content of pages without declared charset, by netloc
+host_encodings = {}
+
+
+def fetch_html(url: (str, request.Request), data=None, headers: dict = {}, method: str = None, encoding: str = None,
+               parser: str = None, session: Session = None, cache: ResponseCache = None,
+               only: bs4.SoupStrainer = None, scheduler: Scheduler = None, transport: Archive = None):
+    response = open_url(url, data, headers, method, session, cache, scheduler, transport)
     if response.getcode() != 200:
+        response.close()
         return None
+    markup = response
+    if _hooks:
+        begin = time.perf_counter()
+        markup = response.read()
+        _emit("download", response.geturl(), seconds=time.perf_counter() - begin, size=len(markup))
     if not encoding:
-        encoding = response.headers.get_charsets()[0]
-    soup = parse_html(response, encoding, parser)
+        host = parse.urlsplit(response.geturl()).netloc
+        encoding = response.headers.get_charsets()[0] or host_encodings.get(host)
+        if not encoding:
+            if markup is response:
+                markup = response.read()
+            begin = time.perf_counter()
+            encoding = phymisc.detect_encoding(markup)
+            if encoding:
+                host_encodings[host] = encoding
+            if _hooks:
+                _emit("decode", response.geturl(), seconds=time.perf_counter() - begin, encoding=encoding)
+    soup = parse_html(markup, encoding, parser, only, response.geturl())
     soup.response = response
     return soup
 
 
-def fetch_file(url: (str, request.Request), data=None, headers: dict = {}, method: str = None):
-    response = open_url(url, data, headers, method)
+class _TextFound(Exception):
+    pass
+
+
+class _TextExtractor(html.parser.HTMLParser):
+    """Collects the stripped text of the first tag matching `selector` from parser events."""
+
+    void_tags = frozenset(("area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param",
+                           "source", "track", "wbr"))
+    # strings bs4 does not count as text of a tag
+    raw_tags = frozenset(("script", "style", "template"))
+
+    def __init__(self, selector, direct):
+        super().__init__()
+        self.selector = selector
+        self.direct = direct
+        self.lines = None
+        self._stack = []
+        self._target = None
+        self._raw = 0
+        self._text = []
+        # void tags opened without "/>", bs4 drops one later end tag of each without ending the string
+        self._voids = []
+
+    def _flush(self):
+        # data may arrive in pieces across fed chunks, bs4 sees each string between two tags as one
+        if not self._text:
+            return
+        data = "".join(self._text).strip()
+        self._text.clear()
+        if data and self._target is not None and not self._raw and \
+                (not self.direct or len(self._stack) == self._target + 1):
+            self.lines.append(data)
+
+    def handle_starttag(self, tag, attrs):
+        self._flush()
+        if tag in self.void_tags:
+            self._voids.append(tag)
+            return
+        self._stack.append(tag)
+        if self._target is not None:
+            if tag in self.raw_tags:
+                self._raw += 1
+        elif self.lines is None and self.selector.matches(_EventTag(tag, attrs)):
+            self.lines = []
+            self._target = len(self._stack) - 1
+
+    def handle_startendtag(self, tag, attrs):
+        self._flush()
+        if self._target is None and self.lines is None and self.selector.matches(_EventTag(tag, attrs)):
+            raise _TextFound()
+
+    def handle_endtag(self, tag):
+        if tag in self._voids:
+            self._voids.remove(tag)
+            return
+        self._flush()
+        if tag not in self._stack:
+            return
+        # like bs4, an end tag also closes the tags left open inside it
+        while True:
+            name = self._stack.pop()
+            if self._target is not None and name in self.raw_tags and self._raw:
+                self._raw -= 1
+            if name == tag:
+                break
+        if self._target is not None and len(self._stack) <= self._target:
+            raise _TextFound()
+
+    def handle_data(self, data):
+        if self._target is not None:
+            self._text.append(data)
+
+    def _special(self, data, text=False):
+        # strings of their own for bs4, only CDATA is in stripped_strings, all are among the direct children
+        self._flush()
+        if self._target is None or self._raw or not (text or self.direct):
+            return
+        if not self.direct or len(self._stack) == self._target + 1:
+            data = data.strip()
+            if data:
+                self.lines.append(data)
+
+    def handle_comment(self, data):
+        self._special(data)
+
+    def handle_pi(self, data):
+        self._special(data)
+
+    def handle_decl(self, decl):
+        self._special(decl[len("DOCTYPE "):] if decl.startswith("DOCTYPE ") else decl)
+
+    def unknown_decl(self, data):
+        if data.upper().startswith("CDATA["):
+            self._special(data[len("CDATA["):], True)
+        else:
+            self._special(data)
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+class _EventTag(dict):
+    """Start tag event looking enough like a bs4 tag for `Selector.matches`."""
+
+    def __init__(self, name, attrs):
+        super().__init__((k, v or "") for k, v in attrs)
+        self.name = name
+        if "class" in self:
+            self["class"] = self["class"].split()
+
+
+def extract_lines(markup, name, clazz=None, id=None, encoding: str = None, direct: bool = False,
+                  chunk_size: int = 16 * 1024) -> list:
+    """Stripped, non-empty strings of the first tag matching `name`, `clazz` and `id`, without building a tree.
+
+    `markup` is text, bytes or a binary file read in chunks until the tag closes. Gives the strings of
+    `tag.stripped_strings`, or with `direct` those of the tag's own children like iterating the tag in bs4.
+    Returns an empty list if the tag is not found.
+    """
+    extractor = _TextExtractor(select(name, clazz, id), direct)
+    decoder = codecs.getincrementaldecoder(encoding or "utf-8")("replace")
+    try:
+        if isinstance(markup, str):
+            extractor.feed(markup)
+        elif isinstance(markup, (bytes, bytearray)):
+            extractor.feed(decoder.decode(markup, True))
+        else:
+            while True:
+                chunk = markup.read(chunk_size)
+                extractor.feed(decoder.decode(chunk, not chunk))
+                if not chunk:
+                    break
+        extractor.close()
+    except _TextFound:
+        pass
+    return extractor.lines or []
+
+
+def fetch_lines(url: (str, request.Request), name, clazz=None, id=None, direct: bool = False, data=None,
+                headers: dict = {}, method: str = None, encoding: str = None, session: Session = None,
+                cache: ResponseCache = None, scheduler: Scheduler = None, transport: Archive = None):
+    """Like `fetch_html` followed by `stripped_strings` of one tag, streaming with `extract_lines`.
+
+    Parsing stops once the tag closes, the rest of the body is only read to keep a `session` connection.
+    Returns None if the page cannot be fetched.
+    """
+    response = open_url(url, data, headers, method, session, cache, scheduler, transport)
+    with response:
+        if response.getcode() != 200:
+            return None
+        markup = response
+        if not encoding:
+            host = parse.urlsplit(response.geturl()).netloc
+            encoding = response.headers.get_charsets()[0] or host_encodings.get(host)
+            if not encoding:
+                markup = response.read()
+                encoding = phymisc.detect_encoding(markup)
+                if encoding:
+                    host_encodings[host] = encoding
+        begin = time.perf_counter() if _hooks else 0
+        lines = extract_lines(markup, name, clazz, id, encoding, direct)
+        if _hooks:
+            _emit("parse", response.geturl(), seconds=time.perf_counter() - begin, parser="stream")
+        if session is not None:
+            # skipping is cheaper than a new connection, an unread body would drop it from the pool
+            while response.read(64 * 1024):
+                pass
+        return lines
+
+
+async def _fetch_html_task(loop, executor, url, kwargs):
+    try:
+        return await loop.run_in_executor(executor, functools.partial(fetch_html, url, **kwargs))
+    except Exception:
+        return None
+
+
+def fetch_html_many(urls, concurrency: int = 8, rate: float = None, session: Session = None, **kwargs):
+    """Fetches `urls` with at most `concurrency` requests in flight and `rate` requests/sec per host.
+
+    Yields soups in the order of `urls`, None for pages that failed, other arguments go to `fetch_html`.
+    A `scheduler` argument takes precedence over `rate`.
+    """
+    own_session = session is None
+    if own_session:
+        session = Session(max_connections=concurrency)
+    kwargs["session"] = session
+    if rate and kwargs.get("scheduler") is None:
+        kwargs["scheduler"] = Scheduler(rate=rate, max_in_flight=concurrency)
+    loop = asyncio.new_event_loop()
+    executor = futures.ThreadPoolExecutor(concurrency)
+    # a window of pending pages keeps the workers busy, memory stays bounded by the window, not by `urls`
+    urls = iter(urls)
+    window = collections.deque()
+    try:
+        for url in itertools.islice(urls, 2 * concurrency):
+            window.append(loop.create_task(_fetch_html_task(loop, executor, url, kwargs)))
+        while window:
+            soup = loop.run_until_complete(window.popleft())
+            for url in itertools.islice(urls, 1):
+                window.append(loop.create_task(_fetch_html_task(loop, executor, url, kwargs)))
+            yield soup
+            soup = None
+    finally:
+        for task in window:
+            task.cancel()
+        if window:
+            loop.run_until_complete(asyncio.gather(*window, return_exceptions=True))
+        loop.close()
+        executor.shutdown()
+        if own_session:
+            session.close()
+
+
+def fetch_file(url: (str, request.Request), data=None, headers: dict = {}, method: str = None,
+               session: Session = None, cache: ResponseCache = None, scheduler: Scheduler = None,
+               transport: Archive = None):
+    response = open_url(url, data, headers, method, session, cache, scheduler, transport)
     if response.getcode() != 200:
+        # a pooled connection is only given back once its response is closed
+        response.close()
         return None
     return response
 
 
-def save_files(urls, path, for_zip=True) -> None:
+def copy_stream(src, dst, chunk_size: int = 64 * 1024) -> int:
+    size = 0
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            return size
+        dst.write(chunk)
+        size += len(chunk)
+
+
+def _save_file(url, fp, session, cache, scheduler, transport):
+    begin = time.perf_counter()
+    with fetch_file(url, session=session, cache=cache, scheduler=scheduler, transport=transport) as img_in:
+        body = time.perf_counter()
+        size = copy_stream(img_in, fp)
+    if _hooks:
+        _emit("download", url, seconds=time.perf_counter() - body, size=size)
+    return size, time.perf_counter() - begin
+
+
+def save_files(urls, path, for_zip=True, session: Session = None, cache: ResponseCache = None,
+               workers: int = 1, scheduler: Scheduler = None, transport: Archive = None) -> None:
+    """Saves `urls` to directory `path` or zip file `path`.zip, downloading with `workers` threads.
+
+    Bodies are streamed in chunks, entries are written to the zip in the order of `urls`.
+    """
+    urls = list(urls)
     zf = zipfile.ZipFile(
         path + ".zip" if not path.endswith(".zip") else path, "w") if for_zip else None
-    for i, url in enumerate(urls, 1):
-        name = "{0:0%d}{1}" % phymisc.number_bits(len(urls))
-        name = name.format(i, os.path.splitext(url)[-1])
-        fp = open(os.path.join(path, name), "wb") if not zf else None
-        with fetch_file(url) as img_in:
-            print("{0}. fetching image: {1}".format(i, url))
-            if zf:
-                zf.writestr(name, img_in.read())
-            else:
-                fp.write(img_in.read())
+    pattern = "{0:0%d}{1}" % phymisc.number_bits(len(urls))
+    names = [pattern.format(i, os.path.splitext(url)[-1]) for i, url in enumerate(urls, 1)]
+    own_session = session is None and workers > 1
+    if own_session:
+        session = Session(max_connections=workers)
+
+    def save(i):
         if not zf:
-            fp.close()
-    if zf:
-        zf.close()
+            with open(os.path.join(path, names[i]), "wb") as fp:
+                return None, _save_file(urls[i], fp, session, cache, scheduler, transport)
+        if workers > 1:
+            # zip entries are written one at a time, so parallel downloads go to temporary files first
+            fp = tempfile.TemporaryFile()
+            return fp, _save_file(urls[i], fp, session, cache, scheduler, transport)
+        with zf.open(names[i], "w") as fp:
+            return None, _save_file(urls[i], fp, session, cache, scheduler, transport)
+
+    executor = futures.ThreadPoolExecutor(workers) if workers > 1 else None
+    try:
+        results = executor.map(save, range(len(urls))) if executor else map(save, range(len(urls)))
+        for i, (tmp, (size, seconds)) in enumerate(results):
+            if tmp:
+                with tmp, zf.open(names[i], "w") as fp:
+                    tmp.seek(0)
+                    copy_stream(tmp, fp)
+            print("{0}. saved image: {1} ({2} bytes, {3:.1f} KB/s)".format(
+                i + 1, urls[i], size, size / 1024 / seconds if seconds else 0))
+    finally:
+        if executor:
+            executor.shutdown()
+        if zf:
+            zf.close()
+        if own_session:
+            session.close()
 
 
 def conv_text(str):
     return str.strip().replace("\xa0", " ")
 
 
-def find_tag(soup, name, clazz=None, id=None):
+def _attrs_of(clazz, id):
     attrs = {}
     if clazz:
         attrs['class'] = clazz
     if id:
         attrs['id'] = id
-    return soup.find(name, attrs)
+    return attrs
+
+
+def find_tag(soup, name, clazz=None, id=None):
+    return soup.find(name, _attrs_of(clazz, id))
 
 
 def find_tags(soup, name, clazz=None, id=None):
-    attrs = {}
-    if clazz:
-        attrs['class'] = clazz
-    if id:
-        attrs['id'] = id
-    return soup.find_all(name, attrs=attrs)
+    return soup.find_all(name, attrs=_attrs_of(clazz, id))
+
+
+def conv_date(format: str):
+    return lambda str: datetime.datetime.strptime(str.strip(), format)
+
+
+class Selector:
+    """Matches a tag by name, class and id like `find_tag`, without going through bs4's SoupStrainer."""
+
+    __slots__ = ("name", "clazz", "id")
+
+    def __init__(self, name, clazz=None, id=None):
+        self.name = name
+        self.clazz = clazz
+        self.id = id
+
+    def _key(self):
+        return self.name, self.clazz, self.id
+
+    def __eq__(self, other):
+        return isinstance(other, Selector) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def matches(self, tag) -> bool:
+        if self.name and tag.name != self.name:
+            return False
+        if self.id and tag.get("id") != self.id:
+            return False
+        if self.clazz:
+            classes = tag.get("class")
+            if not classes or (self.clazz not in classes and " ".join(classes) != self.clazz):
+                return False
+        return True
+
+
+def select(name, clazz=None, id=None) -> Selector:
+    return Selector(name, clazz, id)
+
+
+class Field:
+    """Value found at `path`, a chain of selectors (or tag names) each searched among descendants of the
+    previous match, like chained `find_tag` calls.
+
+    The value is the `attr` attribute or the text of the tag passed through `convert`, or the tag itself with
+    `keep_tag`. With `many` the last step matches all tags and the value is a list.
+    """
+
+    def __init__(self, *path, attr: str = None, convert=conv_text, many: bool = False, keep_tag: bool = False,
+                 default=None):
+        if not path:
+            raise ValueError("'path' require at least one selector")
+        self.path = tuple(step if isinstance(step, Selector) else Selector(step) for step in path)
+        self.attr = attr
+        self.convert = convert
+        self.many = many
+        self.keep_tag = keep_tag
+        self.default = [] if many and default is None else default
+
+    def value_of(self, tag):
+        if self.keep_tag:
+            return tag
+        value = tag.get(self.attr) if self.attr else tag.get_text()
+        return self.convert(value) if self.convert and value is not None else value
+
+
+class _Step:
+    __slots__ = ("selector", "name", "many", "fields", "steps")
+
+    def __init__(self, selector, many):
+        self.selector = selector
+        self.name = selector.name
+        self.many = many
+        self.fields = []
+        self.steps = []
+
+
+class Template:
+    """Named `Field`s compiled once and extracted from a page in a single walk over its tree.
+
+    Fields sharing leading selectors share their first match, e.g. `Field(select("div", "info"), "h1")` and
+    `Field(select("div", "info"), "p")` both look inside the first div.info.
+    """
+
+    def __init__(self, **fields):
+        self.fields = fields
+        self._steps = []
+        self._singles = 0
+        self._many = False
+        for name, field in fields.items():
+            steps = self._steps
+            for i, selector in enumerate(field.path):
+                many = field.many and i == len(field.path) - 1
+                step = next((s for s in steps if s.selector == selector and s.many == many), None)
+                if step is None:
+                    step = _Step(selector, many)
+                    steps.append(step)
+                    if many:
+                        self._many = True
+                    else:
+                        self._singles += 1
+                if i == len(field.path) - 1:
+                    step.fields.append(name)
+                steps = step.steps
+
+    def extract(self, soup) -> dict:
+        result = {}
+        done = set()
+        singles = self._singles
+        stack = [(iter(soup.contents), self._steps)] if self._steps else []
+        while stack:
+            tags, active = stack[-1]
+            tag = next(tags, None)
+            if tag is None:
+                stack.pop()
+                continue
+            name = tag.name
+            if name is None:
+                continue
+            inner = active
+            for step in active:
+                # most tags fail on the name, check it before the full match
+                if step.name and step.name != name or step in done or not step.selector.matches(tag):
+                    continue
+                for key in step.fields:
+                    field = self.fields[key]
+                    if step.many:
+                        result.setdefault(key, []).append(field.value_of(tag))
+                    else:
+                        result[key] = field.value_of(tag)
+                if not step.many:
+                    done.add(step)
+                    singles -= 1
+                    if not singles and not self._many:
+                        stack.clear()
+                        break
+                if step.steps:
+                    inner = inner + step.steps
+            else:
+                if tag.contents:
+                    if done:
+                        inner = [step for step in inner if step not in done]
+                    # nothing left to look for below this tag
+                    if inner:
+                        stack.append((iter(tag.contents), inner))
+        for name, field in self.fields.items():
+            if name not in result:
+                result[name] = list(field.default) if field.many else field.default
+        return result
@@ -14,8 +14,10 @@
 #
 """PW's Misc Library"""
 
+import codecs
 import locale
 import math
+import re
 import sys
 
 # line separator of current system
@@ -79,3 +81,48 @@ def app_error(msg, *args):
 
 def app_usage(msg, *args):
     print("usage: {0} {1}".format(app_name, msg.format(*args)))
+
+
+BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16")
+)
+CANDIDATE_ENCODINGS = ("utf-8", "gb18030", "gbk", "big5")
+# declared legacy Chinese charsets are decoded with their superset
+ENCODING_ALIASES = {"gb2312": "gb18030", "gbk": "gb18030", "x-gbk": "gb18030"}
+_meta_charset = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?\s*([\w.:-]+)""", re.IGNORECASE)
+
+
+def declared_encoding(data: bytes, size: int = 4096):
+    m = _meta_charset.search(data, 0, size)
+    if not m:
+        return None
+    name = m.group(1).decode("ascii").lower()
+    name = ENCODING_ALIASES.get(name, name)
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+
+def detect_encoding(data: bytes, candidates=CANDIDATE_ENCODINGS, sample_size: int = 64 * 1024):
+    """Guesses encoding from BOM, <meta charset> in the first 4 KB, or decoding a bounded sample."""
+    for bom, name in BOMS:
+        if data.startswith(bom):
+            return name
+    name = declared_encoding(data)
+    if name:
+        return name
+    sample = data[:sample_size]
+    final = len(data) < sample_size
+    for name in candidates:
+        try:
+            # not final for a partial sample, the last character may be cut
+            codecs.getincrementaldecoder(name)().decode(sample, final)
+            return name
+        except UnicodeDecodeError:
+            continue
+    return None
@@ -1,12 +1,119 @@
+import contextlib
+import threading
+import time
 import traceback
+from collections import OrderedDict, defaultdict, deque
 
 import pymysql
 from pymysql.cursors import Cursor
 
 
+class LinkBuffer:
+    """Buffers link rows of many inserts and writes them with `executemany` in batches.
+
+    Rows added inside a transaction are kept back until the helper commits and dropped on rollback.
+    """
+
+    def __init__(self, helper, batch_size=1000):
+        self.helper = helper
+        self.batch_size = batch_size
+        self.rows = 0
+        self._ready = defaultdict(list)
+        self._pending = defaultdict(list)
+
+    def __enter__(self):
+        self.helper.links = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            # flush begins its own transaction, which in MySQL would commit the caller's half-done rows
+            self.helper.rollback()
+        self.helper.links = None
+        self.flush()
+
+    def add(self, table, fields, rows):
+        self._pending[(table, fields)].extend(rows)
+
+    def commit(self):
+        size = 0
+        for key, rows in self._pending.items():
+            self._ready[key].extend(rows)
+        self._pending.clear()
+        for rows in self._ready.values():
+            size += len(rows)
+        if size >= self.batch_size:
+            self.flush()
+
+    def rollback(self):
+        self._pending.clear()
+
+    def flush(self):
+        if not self._ready:
+            return
+        conn = self.helper.cursor.connection
+        conn.begin()
+        try:
+            for (table, fields), rows in self._ready.items():
+                sql = 'insert into {0}({1}) values(%s, %s)'.format(table, ','.join(fields))
+                for i in range(0, len(rows), self.batch_size):
+                    batch = rows[i:i + self.batch_size]
+                    self.helper.cursor.executemany(sql, batch)
+                    self.rows += len(batch)
+            conn.commit()
+        except:
+            traceback.print_exc()
+            conn.rollback()
+        self._ready.clear()
+
+
+class IdCache:
+    """Least recently used name to id mapping per table, entries since the last commit are dropped on rollback."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        self._tables = defaultdict(OrderedDict)
+        self._uncommitted = []
+
+    def get(self, table, name):
+        ids = self._tables[table]
+        id = ids.get(name)
+        if id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            ids.move_to_end(name)
+        return id
+
+    def put(self, table, name, id):
+        ids = self._tables[table]
+        ids[name] = id
+        ids.move_to_end(name)
+        self._uncommitted.append((table, name))
+        if len(ids) > self.max_size:
+            ids.popitem(last=False)
+
+    def commit(self):
+        self._uncommitted.clear()
+
+    def rollback(self):
+        for table, name in self._uncommitted:
+            self._tables[table].pop(name, None)
+        self._uncommitted.clear()
+
+    def clear(self):
+        self._tables.clear()
+        self._uncommitted.clear()
+
+
 class PSMHelper:
-    def __init__(self, cursor: Cursor):
+    def __init__(self, cursor: Cursor, cache_size=10000):
         self.cursor = cursor
+        self.links = None
+        self.ids = IdCache(cache_size)
 
     @staticmethod
     def opendb(host="localhost", port=3306, user="root", password="123456", db="psm", charset="utf8"):
@@ -24,9 +131,18 @@ class PSMHelper:
 
     def commit(self):
         self.cursor.connection.commit()
+        self.ids.commit()
+        if self.links is not None:
+            self.links.commit()
 
     def rollback(self):
         self.cursor.connection.rollback()
+        self.ids.rollback()
+        if self.links is not None:
+            self.links.rollback()
+
+    def bulk(self, batch_size=1000) -> LinkBuffer:
+        return LinkBuffer(self, batch_size)
 
     def close(self):
         conn = self.cursor.connection
@@ -36,10 +152,23 @@ class PSMHelper:
     def execute(self, sql: str, *args) -> int:
         return self.cursor.execute(sql, args)
 
+    def warm(self, *tables):
+        """Loads all names and ids of small tables (default 'tag' and 'genre') into the id cache in one query each."""
+        for table in tables or ('tag', 'genre'):
+            self.execute('select id, name from {0} where deleted=0'.format(table))
+            for id, name in self.cursor.fetchall():
+                self.ids.put(table, name, id)
+        self.ids.commit()
+
     def select_id(self, table, value):
+        id = self.ids.get(table, value)
+        if id is not None:
+            return id
         self.execute('select id from {0} where deleted=0 and name=%s'.format(table), value)
         if self.cursor.rowcount > 0:
-            return self.cursor.fetchone()[0]
+            id = self.cursor.fetchone()[0]
+            self.ids.put(table, value, id)
+            return id
         return None
 
     def select_insert(self, table, fields, values) -> int:
@@ -49,15 +178,23 @@ class PSMHelper:
         args = tuple(values[field] for field in fields)
         self.cursor.execute(
             'insert into {0}({1}) values({2})'.format(table, ','.join(fields), '%s,' * (len(fields) - 1) + '%s'), args)
+        self.ids.put(table, values['name'], self.cursor.lastrowid)
         return self.cursor.lastrowid
 
     def insert_links(self, table, fields, id, links, seq_name, item_name):
-        self.begin()
+        if self.links is None:
+            self.begin()
         try:
+            rows = []
             for link in links:
                 if not isinstance(link, int):
                     raise ValueError('{0} require sequence of {1} id'.format(seq_name, item_name))
-                self.execute('insert into {0}({1}) values(%s, %s)'.format(table, ','.join(fields)), id, link)
+                rows.append((id, link))
+            if self.links is not None:
+                self.links.add(table, fields, rows)
+                return
+            if rows:
+                self.cursor.executemany('insert into {0}({1}) values(%s, %s)'.format(table, ','.join(fields)), rows)
             self.commit()
         except:
             traceback.print_exc()
@@ -169,3 +306,120 @@ class PSMHelper:
         self.insert_links('song_composer', ('song_id', 'composer_id'), song_id, composers, 'composers', 'composer')
         self.insert_links('song_arranger', ('song_id', 'arranger_id'), song_id, arrangers, 'arrangers', 'arranger')
         self.insert_links('song_lyricist', ('song_id', 'lyricist_id'), song_id, lyricists, 'lyricists', 'lyricist')
+
+
+class PSMPool:
+    """Bounded pool of pymysql connections handing out one `PSMHelper` per worker.
+
+    Connections idle longer than `ping_interval` seconds are pinged on checkout and replaced when dead,
+    `acquire` raises `TimeoutError` if no connection frees up within `timeout` seconds.
+    """
+
+    def __init__(self, min_size=1, max_size=8, timeout=30, ping_interval=60, **kwargs):
+        if min_size > max_size:
+            raise ValueError('min_size must not exceed max_size')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.kwargs = kwargs
+        self._idle = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        for _ in range(min_size):
+            self._idle.append((self._open(), time.monotonic()))
+            self._size += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _open(self) -> PSMHelper:
+        return PSMHelper.opendb(**self.kwargs)
+
+    def _healthy(self, helper: PSMHelper, since) -> bool:
+        if time.monotonic() - since < self.ping_interval:
+            return True
+        try:
+            helper.cursor.connection.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def acquire(self, timeout=None) -> PSMHelper:
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    helper, since = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    helper = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    raise TimeoutError('no free connection in {0} seconds'.format(timeout))
+        try:
+            if helper is None:
+                return self._open()
+            if not self._healthy(helper, since):
+                with contextlib.suppress(Exception):
+                    helper.close()
+                return self._open()
+            return helper
+        except:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, helper: PSMHelper):
+        with self._cond:
+            self._idle.append((helper, time.monotonic()))
+            self._cond.notify()
+
+    def discard(self, helper: PSMHelper):
+        with contextlib.suppress(Exception):
+            helper.close()
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """Checks out a helper for the enclosed block, use one block per thread or asyncio task."""
+        helper = self.acquire(timeout)
+        try:
+            yield helper
+        except:
+            helper.rollback()
+            raise
+        finally:
+            self.release(helper)
+
+    def local(self) -> PSMHelper:
+        """Returns the helper bound to the calling thread, checking one out on first use."""
+        helper = getattr(self._local, 'helper', None)
+        if helper is None:
+            helper = self._local.helper = self.acquire()
+        return helper
+
+    def release_local(self):
+        helper = getattr(self._local, 'helper', None)
+        if helper is not None:
+            self._local.helper = None
+            self.release(helper)
+
+    def close(self):
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+        for helper, _ in idle:
+            with contextlib.suppress(Exception):
+                helper.close()
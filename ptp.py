@@ -16,68 +16,71 @@
 #
 """Phylame Text Processor"""
 
+import codecs
 import os
+import shutil
 import sys
 import getopt
+import tempfile
+import time
+from concurrent import futures
 from phylib import app_error, app_echo
 import phylib
+import phymisc
 
 
 def remove_null(lines):
     """remove empty lines (default)"""
 
-    result = []
     for line in lines:
         if line.isspace():
             continue
-        result.append(line)
-
-    return result
+        yield line
 
 
 CHAPTER_END_SYMBOLS = tuple("""。？！：…”；’～｀¨．∶＇＂〃,.?!:";'""")
+_end_symbols = frozenset(CHAPTER_END_SYMBOLS)
 
 
 def smart_split(lines):
     """smart split paragraph"""
 
-    result = []
-    buf = ""
+    # pieces of a broken paragraph are joined once, not appended one by one
+    parts = []
     for line in lines:
         s = line.rstrip()
-        if s.endswith(CHAPTER_END_SYMBOLS):
-            if buf:
-                s = buf + s.lstrip()
-                buf = ""
-            result.append(s)
+        if s and s[-1] in _end_symbols:
+            if parts:
+                parts.append(s.lstrip())
+                s = "".join(parts)
+                parts = []
+            yield s
         else:
-            if buf:    # first error line
+            if parts:    # first error line
                 s = s.lstrip()
-            buf += s
-
-    return result
+            if s:
+                parts.append(s)
 
 
 def para_indent(lines):
     """adjust paragraph indentation"""
 
-    result = []
     for line in lines:
         s = line.strip()
         if not s:
             continue
-        s = phylib.PARA_START + s
-        result.append(s)
+        yield phylib.PARA_START + s
 
-    return result
+
+class ProcessError(Exception):
+    """file cannot be processed, reported by the caller"""
 
 
 def split_to_lines(file, func, encoding=None):
     try:
         fp = open(file, "rb")
     except IOError as err:
-        app_error(err)
-        return
+        raise ProcessError(err)
 
     data = fp.read()
     fp.close()
@@ -86,34 +89,156 @@ def split_to_lines(file, func, encoding=None):
         try:
             text = data.decode(encoding)
         except UnicodeDecodeError:
-            app_error("invalid encoding: '{0}'".format(encoding))
-            return
+            raise ProcessError("invalid encoding: '{0}'".format(encoding))
     else:
-        text, encoding = phylib.decode_text(data)
+        encoding = phymisc.detect_encoding(data)
+        text = None
+        if encoding:
+            try:
+                text = data.decode(encoding)
+            except UnicodeDecodeError:
+                pass
+        if text is None:
+            # nothing detected from the sample or the rest did not decode, fall back to full guessing
+            text, encoding = phylib.decode_text(data)
         if text is None:
             err = "cannot decode text file: '{0}'"
-            app_error(err.format(file))
-            return
+            raise ProcessError(err.format(file))
 
     lines = func(text.splitlines())
-    if not isinstance(lines, list):
-        app_error("expected 'list' returned value")
-        return
+    if lines is None or isinstance(lines, str):
+        raise ProcessError("expected iterable of lines returned value")
 
     text = phylib.LN.join(lines)
     data = text.encode(encoding)
     try:
         fp = open(file, "wb")
     except IOError as err:
-        app_error(err)
-        return
+        raise ProcessError(err)
 
     fp.write(data)
     fp.close()
 
 
+CHUNK_SIZE = 1024 * 1024
+SAMPLE_SIZE = 64 * 1024
+
+
+def read_lines(fp, decoder, chunk_size=CHUNK_SIZE):
+    """decode binary file incrementally, yield lines as str.splitlines() does"""
+
+    rest = ""
+    while True:
+        data = fp.read(chunk_size)
+        text = rest + decoder.decode(data, not data)
+        if not data:
+            break
+        lines = text.splitlines(True)
+        # the last piece may be incomplete or a "\r" followed by "\n" in next chunk
+        rest = lines.pop() if lines else ""
+        for line in lines:
+            yield line[:-2] if line.endswith("\r\n") else line[:-1]
+    yield from text.splitlines()
+
+
+def write_lines(fp, encoder, lines, batch=4096):
+    buf = []
+    first = True
+    for line in lines:
+        buf.append(line)
+        if len(buf) == batch:
+            data = phylib.LN.join(buf)
+            fp.write(encoder.encode(data if first else phylib.LN + data))
+            first = False
+            buf.clear()
+    if buf:
+        data = phylib.LN.join(buf)
+        fp.write(encoder.encode(data if first else phylib.LN + data))
+    fp.write(encoder.encode("", True))
+
+
+def stream_lines(file, func, encoding=None):
+    """like split_to_lines but with bounded memory, result replaces the file atomically"""
+
+    try:
+        fp = open(file, "rb")
+    except IOError as err:
+        raise ProcessError(err)
+
+    with fp:
+        sample = fp.read(SAMPLE_SIZE)
+        if encoding:
+            fp.seek(len(sample) - len(phylib.strip_bom(sample)))
+        else:
+            # BOM, if any, is consumed by the decoder of detected encoding
+            encoding = phymisc.detect_encoding(sample, sample_size=SAMPLE_SIZE)
+            if encoding is None:
+                err = "cannot decode text file: '{0}'"
+                raise ProcessError(err.format(file))
+            fp.seek(0)
+        try:
+            decoder = codecs.getincrementaldecoder(encoding)()
+            encoder = codecs.getincrementalencoder(encoding)()
+        except LookupError:
+            raise ProcessError("invalid encoding: '{0}'".format(encoding))
+
+        lines = func(read_lines(fp, decoder))
+        if lines is None or isinstance(lines, str):
+            raise ProcessError("expected iterable of lines returned value")
+
+        path = os.path.dirname(os.path.abspath(file))
+        try:
+            out = tempfile.NamedTemporaryFile("wb", dir=path, prefix=".ptp-", delete=False)
+        except IOError as err:
+            raise ProcessError(err)
+        try:
+            with out:
+                write_lines(out, encoder, lines)
+        except UnicodeDecodeError:
+            os.remove(out.name)
+            raise ProcessError("invalid encoding: '{0}'".format(encoding))
+        except:
+            os.remove(out.name)
+            raise
+
+    shutil.copymode(file, out.name)
+    os.replace(out.name, file)
+
+
+def process_file(process, file, func, encoding):
+    """run in worker processes, errors are returned instead of raised and printed by the parent in order"""
+
+    try:
+        size = os.path.getsize(file)
+        process(file, func, encoding)
+        return size, None
+    except ProcessError as err:
+        return 0, str(err)
+    except Exception as err:
+        return 0, "failed to process '{0}': {1}".format(file, err)
+
+
+def process_files(files, process, func, encoding, jobs):
+    begin = time.perf_counter()
+    total = failed = 0
+    with futures.ProcessPoolExecutor(jobs) as executor:
+        count = len(files)
+        results = executor.map(process_file, [process] * count, files, [func] * count, [encoding] * count,
+                               chunksize=max(1, min(64, count // (jobs * 4))))
+        for file, (size, err) in zip(files, results):
+            app_echo(file)
+            if err is not None:
+                app_error(err)
+                failed += 1
+            total += size
+    seconds = time.perf_counter() - begin or 1e-9
+    msg = "{0} files ({1} failed), {2} bytes in {3:.2f}s: {4:.1f} files/s, {5:.1f} KB/s"
+    app_echo(msg.format(len(files), failed, total, seconds, len(files) / seconds, total / 1024 / seconds))
+    return failed
+
+
 phylib.PROG_NAME = PROG_NAME = "ptp"
-OPTIONS_ARGS = "he:f:"
+OPTIONS_ARGS = "he:f:sj:"
 Commands = {
     "remove-null": remove_null,
     "smart-split": smart_split,
@@ -124,13 +249,58 @@ Commands = {
 def usage():
     s = "usage: {0} [options] files...".format(PROG_NAME)
     print(s)
+    print("commands and scripts are chained in the given order and run in one pass")
     print("options:")
     print(" -e <encoding>     encoding of text file")
     print(" -f <script>       customized script path")
+    print(" -s                streaming mode, for files larger than memory")
+    print("                   (do(lines) of scripts still gets all lines in a list)")
+    print(" -j <jobs>         process files in <jobs> processes")
     for k, v in Commands.items():
         print(" --{0}     {1}".format(k, v.__doc__))
 
 
+class Pipeline:
+    """chain of filters applied in one pass over the lines"""
+
+    def __init__(self, funcs):
+        self.funcs = tuple(funcs)
+
+    def __call__(self, lines):
+        for func in self.funcs:
+            lines = func(lines)
+        return lines
+
+
+class Script:
+    """`do(lines)` of a script, which always got a list of lines"""
+
+    def __init__(self, do):
+        self.do = do
+
+    def __call__(self, lines):
+        return self.do(lines if isinstance(lines, list) else list(lines))
+
+
+def load_script(script):
+    path, base = os.path.split(script)
+    path = path if path else "."
+    sys.path.insert(0, path)
+    name = os.path.splitext(base)[0]
+    try:
+        mod = __import__(name)
+    except Exception as err:
+        msg = "cannot load script '{0}': {1}"
+        app_error(msg.format(script, err))
+        return None
+    try:
+        return Script(mod.do)
+    except AttributeError:
+        msg = "not found function 'do(lines)' in script '{0}'"
+        app_error(msg.format(script))
+        return None
+
+
 def main(argv):
     argv = argv[1:]
     try:
@@ -143,8 +313,9 @@ def main(argv):
     files = phylib.expand_path(extra)
 
     encoding = None
-    script = None
-    func = remove_null
+    process = split_to_lines
+    jobs = 1
+    funcs = []
     for opt, arg in opts:
         if opt == "-e":
             encoding = arg
@@ -152,42 +323,50 @@ def main(argv):
             if not os.path.exists(arg):
                 app_error("not such script: '{0}'".format(arg))
                 return 1
-            script = arg
+            funcs.append(arg)
+        elif opt == "-s":
+            process = stream_lines
+        elif opt == "-j":
+            try:
+                jobs = int(arg)
+            except ValueError:
+                jobs = 0
+            if jobs < 1:
+                app_error("invalid number of jobs: '{0}'".format(arg))
+                return 1
         elif opt == "-h":
             usage()
             sys.exit(0)
         else:
             func = Commands.get(opt.lstrip("-"), None)
+            if func is None:
+                return 1
+            funcs.append(func)
 
     if not files:
         app_error("no input files")
         return 1
 
-    if script:
-        path, base = os.path.split(script)
-        path = path if path else "."
-        sys.path.insert(0, path)
-        name = os.path.splitext(base)[0]
-        try:
-            mod = __import__(name)
-        except Exception as err:
-            msg = "cannot load script '{0}': {1}"
-            app_error(msg.format(script, err))
-            return 1
-        try:
-            func = mod.do
-        except AttributeError:
-            msg = "not found function 'do(lines)' in script '{0}'"
-            app_error(msg.format(script))
-            return 1
-    elif func is None:
-        return 1
+    for i, func in enumerate(funcs):
+        if isinstance(func, str):
+            funcs[i] = load_script(func)
+            if funcs[i] is None:
+                return 1
+    func = Pipeline(funcs) if len(funcs) > 1 else funcs[0] if funcs else remove_null
+
+    if jobs > 1:
+        return 1 if process_files(files, process, func, encoding, jobs) else 0
 
+    failed = 0
     for file in files:
         app_echo(file)
-        split_to_lines(file, func, encoding)
+        try:
+            process(file, func, encoding)
+        except ProcessError as err:
+            app_error(err)
+            failed += 1
 
-    return 0
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
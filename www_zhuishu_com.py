@@ -7,9 +7,23 @@ import datetime
 
 import re
 import yem
+from bookspider import ChapterStore
 from phyhtml import *
+from phymisc import *
 
 ENCODING = "utf-8"
+TEXT_ONLY = strainer('div', id='content')
+# read chapter texts with phyhtml.fetch_lines instead of building a soup
+STREAM_TEXT = True
+
+
+ATTRIBUTES = Template(
+    genre=Field(select('div', 'con_top'), 'a', many=True, convert=None),
+    title=Field(select('div', id='info'), 'h1'),
+    lines=Field(select('div', id='info'), 'p', many=True, keep_tag=True),
+    intro=Field(select('div', id='intro'), keep_tag=True),
+    cover=Field(select('div', id='fmimg'), 'img', attr='src', convert=None)
+)
 
 
 def fetch_attributes(book, url):
@@ -17,34 +31,73 @@ def fetch_attributes(book, url):
     if soup is None:
         app_error('cannot open url: {0}', url)
         return
-    book.genre = find_tag(soup, 'div', 'con_top').find_all('a')[-1].string
-    info = soup.find('div', id='info')
-    book.title = info.h1.string.strip()
-    p = info.p
-    book.author = p.string.split('：')[-1].strip()
-    p = p.find_next('p')
-    book.state = p.next.split('：')[-1][:-1]
-    book.intro = yem.LINE_SEPARATOR.join(tuple(info.find_next('div', id='intro').stripped_strings)[:-1])
-    book.cover = yem.Flob.for_url(info.find_next('div', id='fmimg').next['src'])
+    attrs = ATTRIBUTES.extract(soup)
+    book.genre = attrs['genre'][-1]
+    book.title = attrs['title']
+    p = attrs['lines']
+    book.author = p[0].string.split('：')[-1].strip()
+    book.state = p[1].next.split('：')[-1][:-1]
+    book.intro = yem.LINE_SEPARATOR.join(tuple(attrs['intro'].stripped_strings)[:-1])
+    book.cover = yem.Flob.for_url(attrs['cover'])
     return soup
 
 
-def fetch_contents(book, soup):
+def fetch_contents(book, soup, concurrency=1, rate=None, store: ChapterStore = None):
     host = host_of(soup)
-    for dd in soup.find_all('dd'):
-        a = dd.next
-        chapter = yem.Chapter(title=re.sub(r'\s[\d]{2}-[\d]{2}', '', a.string.strip()))
-        chapter.text = yem.Text.for_html(host + a['href'], fetch_text, tag=chapter)
+    links = [(host + dd.next['href'], re.sub(r'\s[\d]{2}-[\d]{2}', '', dd.next.string.strip()))
+             for dd in soup.find_all('dd')]
+    if not store:
+        if concurrency > 1:
+            soups = fetch_html_many((url for url, _ in links), concurrency, rate, encoding=ENCODING, only=TEXT_ONLY)
+            for (url, title), page in zip(links, soups):
+                print('fetched text:', title)
+                if page is None:
+                    app_error('cannot open url: {0}', url)
+                book.append(yem.Chapter(title=title, text=yem.Text.for_string(parse_text(page))))
+        else:
+            for url, title in links:
+                chapter = yem.Chapter(title=title)
+                chapter.text = yem.Text.for_html(url, fetch_text, tag=chapter)
+                book.append(chapter)
+        return
+    # chapters kept from an earlier run are read back from the store when the book is written
+    missing = [(url, title) for url, title in links if store.track(url, title)]
+    if concurrency > 1:
+        soups = fetch_html_many((url for url, _ in missing), concurrency, rate, encoding=ENCODING, only=TEXT_ONLY)
+        for (url, title), page in zip(missing, soups):
+            print('fetched text:', title)
+            if page is None:
+                app_error('cannot open url: {0}', url)
+            text = parse_text(page)
+            if text:
+                store.put(url, text)
+    fetch = store.fetcher(fetch_text)
+    for url, title in links:
+        chapter = yem.Chapter(title=title)
+        chapter.text = yem.Text.for_html(url, fetch, tag=chapter)
         book.append(chapter)
 
 
 def fetch_text(url, chapter):
     try:
         print('fetching text:', chapter.title)
-        soup = fetch_html(url, encoding=ENCODING)
+        if STREAM_TEXT:
+            lines = fetch_lines(url, 'div', id='content', encoding=ENCODING)
+            if lines is None:
+                app_error('cannot open url: {0}', url)
+                return ''
+            return yem.LINE_SEPARATOR.join(lines)
+        soup = fetch_html(url, encoding=ENCODING, only=TEXT_ONLY)
         if soup is None:
             app_error('cannot open url: {0}', url)
             return ''
+        return parse_text(soup)
+    except:
+        return ''
+
+
+def parse_text(soup):
+    try:
         return yem.LINE_SEPARATOR.join(soup.find('div', id='content').stripped_strings)
     except:
         return ''
@@ -54,8 +107,9 @@ if __name__ == "__main__":
     url = "http://www.mangg.com/id28111/"
     book = yem.Book()
     soup = fetch_attributes(book, url)
-    fetch_contents(book, soup)
     args = {
         "pmab.text.encoding": "gb18030"
     }
-    yem.make_book(book, r"E:\tmp", "pmab", **args)
+    with ChapterStore() as store:
+        fetch_contents(book, soup, concurrency=8, rate=10, store=store)
+        yem.make_book(book, r"E:\tmp", "pmab", **args)
@@ -1,5 +1,10 @@
 import math
+import queue
+import sqlite3
+import threading
 import traceback
+from collections import Counter, deque
+from concurrent import futures
 
 import phyhtml
 import psm
@@ -13,9 +18,47 @@ SEARCH_SONG_URL_PAGED = 'http://www.xiami.com/search/artist/page/{0}?key={1}&cat
 SEARCH_ARTIST_URL = 'http://www.xiami.com/search/artist/?key={0}'
 SEARCH_ARTIST_URL_PAGED = 'http://www.xiami.com/search/artist/page/{0}?key={1}&category=-1'
 
+# set to a phyhtml.ResponseCache to keep fetched pages across runs
+CACHE = None
+
 
 def fetch_soup(url):
-    return phyhtml.fetch_html(url, encoding=ENCODING)
+    soup = phyhtml.fetch_html(url, encoding=ENCODING, cache=CACHE)
+    if soup is not None:
+        soup.url = HOST_URL
+    return soup
+
+
+def make_soup(html):
+    soup = phyhtml.parse_html(html, ENCODING)
+    soup.url = HOST_URL
+    return soup
+
+
+class Checkpoint:
+    """Records finished search pages and detail URLs in a SQLite file so that a rerun skips them."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('create table if not exists done(kind text not null, key text not null, '
+                        'primary key(kind, key))')
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def done(self, kind, key) -> bool:
+        return self.db.execute('select 1 from done where kind=? and key=?', (kind, key)).fetchone() is not None
+
+    def mark(self, kind, key):
+        self.db.execute('insert or ignore into done(kind, key) values(?, ?)', (kind, key))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
 
 
 def left_partition(str, sep=' '):
@@ -29,24 +72,28 @@ def right_partition(str, sep=' '):
 
 
 def escape_href(href, soup):
-    return phyhtml.parse.unquote(href if href.startswith('http') else soup.url + href, encoding=ENCODING)
+    base = soup if isinstance(soup, str) else soup.url
+    return phyhtml.parse.unquote(href if href.startswith('http') else base + href, encoding=ENCODING)
 
 
-def parse_genre(url):
-    soup = fetch_soup(url)
-    name, engname = left_partition(phyhtml.tag_of_class(soup, 'h3', 'bigtext').text.strip())
+def canonical_url(href):
+    url = phyhtml.parse.urldefrag(escape_href(href, HOST_URL))[0]
+    return url.rstrip('/') if url.count('/') > 3 else url
+
+
+def extract_genre(soup, state=None):
+    name, engname = left_partition(phyhtml.find_tag(soup, 'h3', 'bigtext').text.strip())
     lines = []
-    for soup in phyhtml.tag_of_class(soup, 'div', 'content fold'):
+    for soup in phyhtml.find_tag(soup, 'div', 'content fold'):
         if soup.name is None:
             lines.append(soup.strip())
         else:
             lines.append('<br/>')
     intro = '\n'.join(lines)
-    return name, engname, intro
+    return (name, engname, intro), None
 
 
-def parse_artist(url):
-    soup = fetch_soup(url)
+def extract_artist(soup, state=None):
     name = alias = None
     for tag in soup.find('h1'):
         if tag.name is None:
@@ -63,7 +110,7 @@ def parse_artist(url):
                 for a in tag.find_all('a'):
                     genres.append((left_partition(a.text.strip()), escape_href(a['href'], soup)))
             elif label == '档案：':
-                a = phyhtml.tag_of_class(tag, 'a', 'more')
+                a = phyhtml.find_tag(tag, 'a', 'more')
                 if a:
                     profile = escape_href(a['href'], soup)
             label = None
@@ -71,26 +118,28 @@ def parse_artist(url):
             label = tag.text.strip()
 
     cover = soup.find('a', dict(id='cover_lightbox'))['href']
-    intro = None
     if profile:
-        soup = fetch_soup(profile)
-        div = phyhtml.tag_of_class(soup, 'div', 'profile')
-        lines = []
-        if div:
-            for tag in div.find_all('p'):
-                lines.append(str(tag))
-        else:
-            for tag in soup.find('div', dict(id='artist-record')):
-                if tag.name is None:
-                    lines.append(tag.strip())
-                elif tag.name == 'br':
-                    lines.append('<br/>')
-        intro = ''.join(lines)
-    return name, alias, cover, location, genres, intro
+        return None, ('profile', profile, (name, alias, cover, location, genres))
+    return (name, alias, cover, location, genres, None), None
 
 
-def parse_song(url):
-    soup = fetch_soup(url)
+def extract_profile(soup, artist):
+    div = phyhtml.find_tag(soup, 'div', 'profile')
+    lines = []
+    if div:
+        for tag in div.find_all('p'):
+            lines.append(str(tag))
+    else:
+        for tag in soup.find('div', dict(id='artist-record')):
+            if tag.name is None:
+                lines.append(tag.strip())
+            elif tag.name == 'br':
+                lines.append('<br/>')
+    intro = ''.join(lines)
+    return artist + (intro,), None
+
+
+def extract_song(soup, state=None):
     title = alias = None
     for tag in soup.find('h1'):
         if tag.name is None:
@@ -100,7 +149,7 @@ def parse_song(url):
     main = soup.find('div', dict(id='main'))
     label = album = lyricist = composer = arranger = None
     artists = []
-    for tag in phyhtml.tag_of_class(main, 'div', 'album_relation').find_all('td'):
+    for tag in phyhtml.find_tag(main, 'div', 'album_relation').find_all('td'):
         text = tag.text.strip()
         if label is not None:
             if label == '所属专辑：':
@@ -121,17 +170,16 @@ def parse_song(url):
         else:
             label = text
     lines = []
-    for tag in phyhtml.tag_of_class(main, 'div', 'lrc_main'):
+    for tag in phyhtml.find_tag(main, 'div', 'lrc_main'):
         if tag.name is None:
             lines.append(tag.strip())
         else:
             lines.append('<br/>')
     lyric = ''.join(lines)
-    return title, alias, album, artists, lyricist, composer, arranger, lyric
+    return (title, alias, album, artists, lyricist, composer, arranger, lyric), None
 
 
-def parse_album(url):
-    soup = fetch_soup(url)
+def extract_album(soup, state=None):
     title = alias = None
     for tag in soup.find('h1'):
         if tag.name is None:
@@ -171,47 +219,439 @@ def parse_album(url):
         for tag in span:
             lines.append(str(tag))
         intro = ''.join(lines)
-    return title, alias, cover, artists, language, publisher, pubdate, category, genres, intro
+    return (title, alias, cover, artists, language, publisher, pubdate, category, genres, intro), None
 
 
-def fetch_albums(url, func, filter=None):
-    soup = fetch_soup(url)
-    for tag in phyhtml.tag_of_class(soup, 'div', 'albumBlock_list').find_all('li'):
-        if not filter or filter(tag):
-            func(parse_album(phyhtml.tag_of_class(tag, 'p', 'cover').next['href']))
+# extractors take a soup and the state carried from the previous page, and return the result or, when another
+# page is needed, (None, (kind, url, state))
+EXTRACTORS = {
+    'genre': extract_genre,
+    'artist': extract_artist,
+    'profile': extract_profile,
+    'album': extract_album,
+    'song': extract_song
+}
+
+
+def extract(kind, html, state=None):
+    return EXTRACTORS[kind](make_soup(html), state)
 
 
-def search_album(key, func, page=None, size=30, filter=None):
+def parse_page(kind, url):
+    state = None
+    while True:
+        result, follow = EXTRACTORS[kind](fetch_soup(url), state)
+        if follow is None:
+            return result
+        kind, url, state = follow
+
+
+def parse_genre(url):
+    return parse_page('genre', url)
+
+
+def parse_artist(url):
+    return parse_page('artist', url)
+
+
+def parse_song(url):
+    return parse_page('song', url)
+
+
+def parse_album(url):
+    return parse_page('album', url)
+
+
+PARSERS = {
+    'genre': parse_genre,
+    'artist': parse_artist,
+    'album': parse_album,
+    'song': parse_song
+}
+
+
+class Frontier:
+    """Typed queue of entity pages where each canonical URL is fetched and parsed once per run.
+
+    Results of kinds in `memo` are kept and handed out again to later `parse` calls for the same page.
+    """
+
+    def __init__(self, memo=('genre',)):
+        self.memo = memo
+        self.queue = deque()
+        self.seen = set()
+        self.results = {}
+        self.fetched = Counter()
+        self.duplicates = Counter()
+        self._lock = threading.Lock()
+
+    def visit(self, kind, url) -> bool:
+        """Marks the page seen, returns False if it was already."""
+        url = canonical_url(url)
+        with self._lock:
+            if url in self.seen:
+                self.duplicates[kind] += 1
+                return False
+            self.seen.add(url)
+            return True
+
+    def push(self, kind, url) -> bool:
+        if not self.visit(kind, url):
+            return False
+        with self._lock:
+            self.queue.append((kind, url))
+        return True
+
+    def pop(self):
+        with self._lock:
+            return self.queue.popleft() if self.queue else None
+
+    def parse(self, kind, url):
+        """Parses the page of `kind` once, None for repeated pages of kinds not memorized."""
+        key = canonical_url(url)
+        with self._lock:
+            if key in self.results:
+                self.duplicates[kind] += 1
+                return self.results[key]
+        if not self.visit(kind, url) and kind not in self.memo:
+            return None
+        result = PARSERS[kind](url)
+        with self._lock:
+            self.fetched[kind] += 1
+            if kind in self.memo:
+                self.results[key] = result
+        return result
+
+    def run(self, handlers: dict, workers=1):
+        """Feeds queued pages to `handlers[kind](result, frontier)` until the queue drains, handlers may push more."""
+
+        def process(item):
+            kind, url = item
+            result = PARSERS[kind](url)
+            with self._lock:
+                self.fetched[kind] += 1
+            handlers[kind](result, self)
+
+        with futures.ThreadPoolExecutor(workers) as executor:
+            pending = set()
+            while True:
+                item = self.pop()
+                while item is not None and len(pending) < workers * 2:
+                    pending.add(executor.submit(process, item))
+                    item = self.pop()
+                if item is not None:
+                    with self._lock:
+                        self.queue.appendleft(item)
+                if not pending:
+                    break
+                done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception():
+                        traceback.print_exception(None, future.exception(), future.exception().__traceback__)
+
+    def summary(self) -> str:
+        kinds = sorted(set(self.fetched) | set(self.duplicates))
+        return ', '.join('{0}: {1} fetched, {2} deduplicated'.format(kind, self.fetched[kind], self.duplicates[kind])
+                         for kind in kinds)
+
+
+def follow_links(func):
+    """Builds `Frontier.run` handlers passing each result to `func(kind, result)` and queueing linked pages."""
+
+    def push_all(frontier, kind, links):
+        for _, url in links:
+            if url:
+                frontier.push(kind, url)
+
+    def artist(result, frontier):
+        func('artist', result)
+        push_all(frontier, 'genre', result[4])
+
+    def album(result, frontier):
+        func('album', result)
+        push_all(frontier, 'artist', result[3])
+        push_all(frontier, 'genre', result[8])
+
+    def song(result, frontier):
+        func('song', result)
+        push_all(frontier, 'album', (result[2],) if result[2] else ())
+        push_all(frontier, 'artist', result[3])
+
+    return {'genre': lambda result, frontier: func('genre', result), 'artist': artist, 'album': album, 'song': song}
+
+
+class CrawlPipeline:
+    """Fetch, parse and write stages running at their own pace.
+
+    `fetchers` threads download pages, a process pool of `parsers` workers runs the extractors and one writer
+    thread passes lists of up to `batch_size` (kind, result) to `write`. At most `max_pending` items are inside
+    the pipeline at once, so `run` blocks while a slower stage catches up.
+
+    `requires(kind, result)` lists (kind, url) pages a result depends on, they go through the fetch and parse
+    stages once per run and are written before it, so `write` never has to fetch.
+    """
+
+    def __init__(self, write, fetchers=4, parsers=None, max_pending=64, batch_size=20, flush_interval=1.0,
+                 requires=None):
+        self.write = write
+        self.requires = requires
+        self.fetchers = fetchers
+        self.parsers = parsers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.fetched = self.parsed = self.written = self.failed = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._fetch_queue = queue.Queue()
+        self._parse_queue = queue.Queue()
+        self._write_queue = queue.Queue()
+        # canonical url of a required page: entries [kind, result, unresolved count] waiting for it
+        self._waiting = {}
+        self._resolved = set()
+
+    def _done(self, count=1, failed=False):
+        if failed:
+            with self._lock:
+                self.failed += count
+        for _ in range(count):
+            self._slots.release()
+
+    def _fetch(self, pool):
+        while True:
+            item = self._fetch_queue.get()
+            if item is None:
+                return
+            kind, url, state = item[:3]
+            try:
+                with phyhtml.fetch_file(url, cache=CACHE) as response:
+                    html = response.read()
+                with self._lock:
+                    self.fetched += 1
+                future = pool.submit(extract, kind, html, state)
+            except Exception as e:
+                # reported by the dispatcher
+                future = futures.Future()
+                future.set_exception(e)
+            self._parse_queue.put((item, future))
+
+    def _park(self, kind, result):
+        entry = [kind, result, 0]
+        for required_kind, url in self.requires(kind, result) if self.requires else ():
+            key = canonical_url(url)
+            if key in self._resolved:
+                continue
+            waiting = self._waiting.get(key)
+            if waiting is None:
+                self._waiting[key] = waiting = []
+                self._fetch_queue.put((required_kind, url, None, key, required_kind))
+            waiting.append(entry)
+            entry[2] += 1
+        if not entry[2]:
+            self._write_queue.put((kind, result, True))
+
+    def _resolve(self, key):
+        self._resolved.add(key)
+        for entry in self._waiting.pop(key, ()):
+            entry[2] -= 1
+            if not entry[2]:
+                self._write_queue.put((entry[0], entry[1], True))
+
+    def _dispatch(self):
+        while True:
+            item = self._parse_queue.get()
+            if item is None:
+                return
+            # kind of the page, and of the entity it is part of when following e.g. an artist to its profile
+            (_, url, _, required, kind), future = item
+            try:
+                result, follow = future.result()
+                self.parsed += 1
+            except Exception:
+                traceback.print_exc()
+                if required is None:
+                    self._done(failed=True)
+                else:
+                    # written without it, waiting results must not hang
+                    with self._lock:
+                        self.failed += 1
+                    self._resolve(required)
+                continue
+            if follow is not None:
+                self._fetch_queue.put(follow + (required, kind))
+            elif required is not None:
+                # required pages hold no slot and are queued before the results waiting for them
+                self._write_queue.put((kind, result, False))
+                self._resolve(required)
+            else:
+                self._park(kind, result)
+
+    def _write(self):
+        batch = []
+        slots = 0
+        finished = False
+        while not finished:
+            try:
+                item = self._write_queue.get(timeout=self.flush_interval)
+                idle = False
+            except queue.Empty:
+                item = None
+                idle = True
+            if item is not None:
+                kind, result, owned = item
+                batch.append((kind, result))
+                slots += owned
+            elif not idle:
+                finished = True
+            if batch and (idle or finished or len(batch) >= self.batch_size):
+                try:
+                    self.write(batch)
+                    self.written += len(batch)
+                    self._done(slots)
+                except Exception:
+                    traceback.print_exc()
+                    self._done(slots, True)
+                batch = []
+                slots = 0
+
+    def run(self, kind, urls):
+        """Pushes pages of `kind` through the pipeline and returns when all are written."""
+        with futures.ProcessPoolExecutor(self.parsers) as pool:
+            fetchers = [threading.Thread(target=self._fetch, args=(pool,), daemon=True) for _ in range(self.fetchers)]
+            dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+            writer = threading.Thread(target=self._write, daemon=True)
+            for thread in fetchers + [dispatcher, writer]:
+                thread.start()
+            count = 0
+            for url in urls:
+                self._slots.acquire()
+                self._fetch_queue.put((kind, url, None, None, kind))
+                count += 1
+            # every slot back means every item was written or failed
+            for _ in range(self.max_pending):
+                self._slots.acquire()
+            for _ in fetchers:
+                self._fetch_queue.put(None)
+            for thread in fetchers:
+                thread.join()
+            self._parse_queue.put(None)
+            dispatcher.join()
+            self._write_queue.put(None)
+            writer.join()
+            for _ in range(self.max_pending):
+                self._slots.release()
+        return count
+
+    def summary(self) -> str:
+        return 'pipeline: {0} fetched, {1} parsed, {2} written, {3} failed'.format(
+            self.fetched, self.parsed, self.written, self.failed)
+
+
+# kind: (count page url, paged url, class of count tag, items of a page, detail href of an item)
+SEARCHES = {
+    'album': (SEARCH_ALBUM_URL, SEARCH_ALBUM_URL_PAGED, 'seek_counts',
+              lambda soup: phyhtml.find_tag(soup, 'div', 'albumBlock_list').find_all('li'),
+              lambda tag: phyhtml.find_tag(tag, 'p', 'cover').next['href']),
+    'artist': (SEARCH_SONG_URL, SEARCH_SONG_URL_PAGED, 'seek_counts ok',
+               lambda soup: phyhtml.find_tags(soup, 'p', 'buddy'),
+               lambda tag: tag.next['href'])
+}
+
+
+def iter_search_pages(kind, key, start=1, size=30, prefetch=True, skip=None):
+    """Yields (url, items) of result pages from `start`, fetching the next page while the current is processed.
+
+    The count page is fetched once, pages for which `skip(url)` is true are not fetched at all.
+    """
+    count_url, paged_url, count_class, items_of, _ = SEARCHES[kind]
+    soup = fetch_soup(count_url.format(key))
+    total = int(phyhtml.find_tag(soup, 'p', count_class).next.next.text)
+    count = int(math.ceil(total / size))
+    print("found", total, kind + 's in', count, 'pages')
+    urls = [paged_url.format(page, key) for page in range(start, count + 1)]
+    if skip:
+        urls = [url for url in urls if not skip(url)]
+    if not prefetch:
+        for url in urls:
+            yield url, items_of(fetch_soup(url))
+        return
+    with futures.ThreadPoolExecutor(1) as executor:
+        future = executor.submit(fetch_soup, urls[0]) if urls else None
+        for i, url in enumerate(urls):
+            soup = future.result()
+            if i + 1 < len(urls):
+                future = executor.submit(fetch_soup, urls[i + 1])
+            yield url, items_of(soup)
+
+
+def iter_search(kind, key, start=1, size=30, prefetch=True):
+    """Yields result items of search for 'album' or 'artist' lazily, page by page."""
+    for _, items in iter_search_pages(kind, key, start, size, prefetch):
+        yield from items
+
+
+def process_items(kind, url, items, func, filter=None, checkpoint: Checkpoint = None, frontier: Frontier = None):
+    href_of = SEARCHES[kind][4]
+    for tag in items:
+        if not filter or filter(tag):
+            href = href_of(tag)
+            if checkpoint and checkpoint.done(kind, href):
+                continue
+            item = frontier.parse(kind, href) if frontier else PARSERS[kind](href)
+            if item is not None:
+                func(item)
+            if checkpoint:
+                checkpoint.mark(kind, href)
+    if checkpoint:
+        checkpoint.mark('page', url)
+
+
+def fetch_albums(url, func, filter=None, checkpoint: Checkpoint = None, frontier: Frontier = None):
+    if checkpoint and checkpoint.done('page', url):
+        return
+    process_items('album', url, SEARCHES['album'][3](fetch_soup(url)), func, filter, checkpoint, frontier)
+
+
+def search(kind, key, func, start=1, size=30, filter=None, checkpoint: Checkpoint = None,
+           frontier: Frontier = None):
+    skip = (lambda url: checkpoint.done('page', url)) if checkpoint else None
+    for url, items in iter_search_pages(kind, key, start, size, skip=skip):
+        print("fetch", kind, "in page:", url)
+        process_items(kind, url, items, func, filter, checkpoint, frontier)
+
+
+def search_album(key, func, page=None, size=30, filter=None, checkpoint: Checkpoint = None,
+                 frontier: Frontier = None):
     if page is not None:
         print("fetch album in page:", page)
-        fetch_albums(SEARCH_ALBUM_URL_PAGED.format(page, key), func, filter)
-    soup = fetch_soup(SEARCH_ALBUM_URL.format(key))
-    total = int(phyhtml.tag_of_class(soup, 'p', 'seek_counts').next.next.text)
-    count = int(math.ceil(total / size))
-    print("found", total, 'albums in', count, 'pages')
-    for page in range(1, count + 1):
-        search_album(key, func, page, size, filter)
+        return fetch_albums(SEARCH_ALBUM_URL_PAGED.format(page, key), func, filter, checkpoint, frontier)
+    search('album', key, func, 1, size, filter, checkpoint, frontier)
 
 
-def fetch_artists(url, func, filter=None):
-    soup = fetch_soup(url)
-    for tag in phyhtml.tags_of_class(soup, 'p', 'buddy'):
-        if not filter or filter(tag):
-            func(parse_artist(tag.next['href']))
+def fetch_artists(url, func, filter=None, checkpoint: Checkpoint = None, frontier: Frontier = None):
+    if checkpoint and checkpoint.done('page', url):
+        return
+    process_items('artist', url, SEARCHES['artist'][3](fetch_soup(url)), func, filter, checkpoint, frontier)
 
 
-def search_artist(key, func, page=None, size=30, filter=None):
+def search_artist(key, func, page=None, size=30, filter=None, checkpoint: Checkpoint = None,
+                  frontier: Frontier = None):
     if page is not None:
-        return fetch_artists(SEARCH_SONG_URL_PAGED.format(page, key), func, filter)
-    soup = fetch_soup(SEARCH_SONG_URL.format(key))
-    total = int(phyhtml.tag_of_class(soup, 'p', 'seek_counts ok').next.next.text)
-    for page in range(1, int(math.ceil(total / size)) + 1):
-        search_artist(key, func, page, size, filter)
+        return fetch_artists(SEARCH_SONG_URL_PAGED.format(page, key), func, filter, checkpoint, frontier)
+    search('artist', key, func, 1, size, filter, checkpoint, frontier)
+
+
+def search_artist_urls(key, size=30, filter=None):
+    """Yields artist page URLs of search results, for feeding `CrawlPipeline.run`."""
+    href_of = SEARCHES['artist'][4]
+    for tag in iter_search('artist', key, size=size):
+        if not filter or filter(tag):
+            yield href_of(tag)
 
 
 def fetch_genres(helper: psm.PSMHelper, offset: int = 0):
     soup = fetch_soup('http://www.xiami.com/genre')
-    seq = tuple(zip(phyhtml.tags_of_class(soup, 'dt', 'fold'), phyhtml.tags_of_class(soup, 'dd', 'fold')))
+    seq = tuple(zip(phyhtml.find_tags(soup, 'dt', 'fold'), phyhtml.find_tags(soup, 'dd', 'fold')))
     for dt, dd in seq[offset:] if offset > 0 else seq:
         group = parse_genre(soup.url + dt.find('a')['href'])
         for a in dd.find_all('a'):
@@ -220,14 +660,28 @@ def fetch_genres(helper: psm.PSMHelper, offset: int = 0):
 
 def album_artist_filter(artist):
     def do_filter(li):
-        a = phyhtml.tag_of_class(li, 'a', 'singer')
+        a = phyhtml.find_tag(li, 'a', 'singer')
         if a:
             return a.text == artist
 
     return lambda li: do_filter(li)
 
 
-def process_artist(artist, helper: psm.PSMHelper):
+def process_genre(genre, helper: psm.PSMHelper):
+    name, engname, intro = genre[:3]
+    if helper.select_genre(name) is not None:
+        return
+    helper.begin()
+    try:
+        helper.insert_genre(name, engname=engname, intro=intro)
+        print("inserted genre:", name)
+        helper.commit()
+    except:
+        traceback.print_exc()
+        helper.rollback()
+
+
+def process_artist(artist, helper: psm.PSMHelper, frontier: Frontier = None, fetch: bool = True):
     name, alias, cover, location, genres, intro = artist
     if location:
         if location[0]:
@@ -243,7 +697,9 @@ def process_artist(artist, helper: psm.PSMHelper):
             genre_id = helper.select_genre(genre[0][0])
             if genre_id is None:
                 print("not found genre:", genre[0][0])
-                genre = parse_genre(genre[1])
+                if not fetch:
+                    continue
+                genre = frontier.parse('genre', genre[1]) if frontier else parse_genre(genre[1])
                 print("fetch genre:", genre)
                 genre_ids.append(helper.insert_genre(genre[0], engname=genre[1], intro=genre[2]))
             else:
@@ -256,6 +712,36 @@ def process_artist(artist, helper: psm.PSMHelper):
         helper.rollback()
 
 
+def artist_requires(kind, result):
+    """Genre pages of an artist, for `CrawlPipeline(requires=...)`."""
+    if kind != 'artist':
+        return ()
+    return [('genre', genre[1]) for genre in result[4] if genre[1]]
+
+
+def artist_writer(helper: psm.PSMHelper):
+    """Writer for `CrawlPipeline(requires=artist_requires)` storing genres and artists with buffered link rows.
+
+    Genres arrive parsed ahead of the artists linking them, the writer only touches the database.
+    """
+
+    def write(batch):
+        with helper.bulk():
+            for kind, result in batch:
+                if kind == 'genre':
+                    process_genre(result, helper)
+                else:
+                    process_artist(result, helper, fetch=False)
+
+    return write
+
+
 if __name__ == '__main__':
-    with psm.PSMHelper.opendb() as helper:
-        search_artist('古风', lambda album: process_artist(album, helper))
+    frontier = Frontier()
+    with psm.PSMHelper.opendb() as helper, Checkpoint('xiami.db') as checkpoint, phyhtml.Metrics() as metrics:
+        helper.warm('genre')
+        search_artist('古风', lambda album: process_artist(album, helper, frontier), checkpoint=checkpoint,
+                      frontier=frontier)
+        print('id cache:', helper.ids.hits, 'hits,', helper.ids.misses, 'misses')
+        print('frontier:', frontier.summary())
+        print(metrics.summary())